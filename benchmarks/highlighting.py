@@ -0,0 +1,408 @@
+"""Highlighting benchmarks on generated Python, JSON and C files.
+
+Every case runs in a process of its own, where it opens a generated file in a
+fresh `highlight_process`, then edits a line in the middle of it, and applies
+the resulting tokens to a `Document`.
+
+    python -m benchmarks.highlighting --output results.json
+    python -m benchmarks.highlighting --compare results.json
+
+Applying tags needs a display, run under `xvfb-run` on a headless machine.
+Without one, only the highlighter process is measured.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+from multiprocessing import Pipe, Process, get_context
+from multiprocessing.connection import Connection
+from multiprocessing.reduction import ForkingPickler
+from tkinter import StringVar, TclError, Tk
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sublime_tkext.config import Settings
+from sublime_tkext.editor import Document
+from sublime_tkext.highlight import (
+    HighlightRequest,
+    HighlightResponse,
+    SharedText,
+    highlight_process,
+)
+from sublime_tkext.saver import FileSaver
+
+SIZES = (1_000, 10_000, 100_000)
+VIEWPORT = (1, 50)
+
+# Corpora
+
+
+def python_lines(rng: random.Random) -> List[str]:
+    name = f"function_{rng.randrange(10**6)}"
+    return [
+        f"def {name}(value, *args, scale={rng.random():.3f}, **kwargs):",
+        f'    """Return {name} of `value`."""',
+        f"    if value > {rng.randrange(100)}:  # large values",
+        f"        return [x * scale for x in range(value) if x % {rng.randrange(2, 9)}]",
+        f"    text = f\"{{value!r}} is {rng.choice(['small', 'odd', 'empty'])}\"",
+        "    return {'value': value, 'text': text, 'args': args}",
+        "",
+    ]
+
+
+def json_lines(rng: random.Random) -> List[str]:
+    return [
+        "  {",
+        f'    "id": {rng.randrange(10**6)},',
+        f'    "name": "item \\"{rng.randrange(1000)}\\"",',
+        f'    "price": {rng.random() * 100:.2f},',
+        f'    "tags": ["{rng.choice(["a", "b", "c"])}", null, true, false],',
+        "  },",
+    ]
+
+
+def c_lines(rng: random.Random) -> List[str]:
+    name = f"function_{rng.randrange(10**6)}"
+    return [
+        f"/* {name}: sums the first n values */",
+        f"static int {name}(const int *values, size_t n) {{",
+        f"    int total = {rng.randrange(100)};",
+        "    for (size_t i = 0; i < n; i++) {",
+        f"        total += values[i] * 0x{rng.randrange(256):02x}; // scaled",
+        "    }",
+        f'    printf("%d\\n", total); return total > {rng.randrange(10)};',
+        "}",
+        "",
+    ]
+
+
+def generate(
+    lines: Callable[[random.Random], List[str]],
+    count: int,
+    head: List[str],
+    tail: List[str],
+    seed: int = 0,
+) -> str:
+    rng = random.Random(seed)
+    output = list(head)
+    while len(output) < count - len(tail):
+        output.extend(lines(rng))
+    output = output[: count - len(tail)] + tail
+    return "\n".join(output) + "\n"
+
+
+CORPORA: Dict[str, Tuple[str, Callable[[int], str]]] = {
+    "python": (
+        "py",
+        lambda count: generate(python_lines, count, ["import os", ""], []),
+    ),
+    "json": (
+        "json",
+        lambda count: generate(json_lines, count, ["["], ["  {}", "]"]),
+    ),
+    "c": (
+        "c",
+        lambda count: generate(c_lines, count, ["#include <stdio.h>", ""], []),
+    ),
+}
+
+
+EDIT = 'name = "edited"\n'
+
+
+def middle_line(text: str) -> int:
+    """Line at which `EDIT` is inserted, opening a string that is closed again
+    on the same line."""
+    return text.count("\n", 0, len(text) // 2) + 2
+
+
+def insert_line(text: str, line: int, inserted: str) -> str:
+    offset = 0
+    for _ in range(line - 1):
+        offset = text.index("\n", offset) + 1
+    return text[:offset] + inserted + text[offset:]
+
+
+# Highlighter process
+
+
+def peak_rss_kb(pid: int) -> Optional[int]:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class HighlighterProcess:
+    """A `highlight_process` fed through its pipe like `PygmentsHighlighter`
+    does, counting the bytes that cross it."""
+
+    def __init__(self) -> None:
+        self.connection, inner_connection = Pipe()
+        self.process = Process(
+            target=highlight_process, args=(inner_connection,), daemon=True
+        )
+        self.process.start()
+        self.tag_names: List[str] = []
+        self.shared_text = SharedText()
+
+    def close(self):
+        self.process.terminate()
+        self.process.join()
+        self.shared_text.close()
+
+    def highlight(self, req: HighlightRequest, shared: bool) -> Dict[str, Any]:
+        """Send `req` and wait for the worker to finish it."""
+        if shared:
+            req.shared = self.shared_text.write(req.text, req.version)
+            req.text = ""
+        start = time.perf_counter()
+        request_bytes = ForkingPickler.dumps(req)
+        self.connection.send_bytes(request_bytes)
+        responses: List[HighlightResponse] = []
+        response_bytes = 0
+        first_response = None
+        while True:
+            data = self.connection.recv_bytes()
+            if first_response is None:
+                first_response = time.perf_counter() - start
+            response_bytes += len(data)
+            rsp: HighlightResponse = ForkingPickler.loads(data)
+            self.tag_names.extend(rsp.new_tag_names)
+            responses.append(rsp)
+            if rsp.handled > 0:
+                break
+        return {
+            "lex_s": time.perf_counter() - start,
+            "first_response_s": first_response,
+            "request_bytes": len(request_bytes),
+            "response_bytes": response_bytes,
+            "responses": len(responses),
+            "tokens": sum(len(rsp.tokens) for rsp in responses),
+            "_responses": responses,
+        }
+
+
+# Tag application
+
+
+class NullHighlighter:
+    """Swallows the requests of the benchmarked `Document`, whose tags are
+    applied from the responses collected beforehand."""
+
+    def send_highlight_request(self, *args, **kwargs):
+        pass
+
+    def send_viewport(self, *args, **kwargs):
+        pass
+
+
+def apply_responses(
+    document: Document, responses: List[HighlightResponse], tag_names: List[str]
+) -> float:
+    start = time.perf_counter()
+    for rsp in responses:
+        document.update_tags(rsp.tokens, tag_names, rsp.start, rsp.end)
+    document.update_idletasks()
+    return time.perf_counter() - start
+
+
+# Runner
+
+
+def run_case(
+    root: Optional[Tk], language: str, lines: int, shared: bool
+) -> Dict[str, Any]:
+    extension, make_text = CORPORA[language]
+    text = make_text(lines)
+    line = middle_line(text)
+    edited = insert_line(text, line, EDIT)
+    path = f"benchmark.{extension}"
+
+    highlighter = HighlighterProcess()
+    try:
+        # Loading Pygments and the lexer is paid once per process, not per file
+        startup = highlighter.highlight(
+            HighlightRequest(file_id="warm-up", text=text[:1000], path=path), False
+        )
+        opened = highlighter.highlight(
+            HighlightRequest(
+                file_id=path, text=text, path=path, version=0, viewport=VIEWPORT
+            ),
+            shared,
+        )
+        edit = highlighter.highlight(
+            HighlightRequest(
+                file_id=path,
+                text=edited,
+                path=path,
+                version=1,
+                applied_version=0,
+                viewport=VIEWPORT,
+            ),
+            shared,
+        )
+        worker_rss = peak_rss_kb(highlighter.process.pid)
+    finally:
+        highlighter.close()
+
+    if root is not None:
+        document = Document(
+            root,
+            tab_name=StringVar(root),
+            settings=Settings(),
+            highlighter=NullHighlighter(),  # type: ignore
+            saver=FileSaver(),
+        )
+        document.content.insert("1.0", text)
+        opened["tag_s"] = apply_responses(
+            document, opened["_responses"], highlighter.tag_names
+        )
+        # Nothing changes, only the diff against the widget's tags is paid
+        opened["retag_s"] = apply_responses(
+            document, opened["_responses"], highlighter.tag_names
+        )
+        document.content.insert(f"{line}.0", EDIT)
+        edit["tag_s"] = apply_responses(
+            document, edit["_responses"], highlighter.tag_names
+        )
+        document.destroy()
+
+    for phase in (opened, edit):
+        del phase["_responses"]
+    return {
+        "language": language,
+        "lines": lines,
+        "characters": len(text),
+        "startup_s": startup["lex_s"],
+        "open": opened,
+        "edit": edit,
+        "worker_peak_rss_kb": worker_rss,
+        "ui_peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def _case_process(
+    connection: Connection, language: str, lines: int, shared: bool, tags: bool
+):
+    root = None
+    if tags:
+        try:
+            root = Tk()
+            root.withdraw()
+        except TclError:
+            pass
+    connection.send(run_case(root, language, lines, shared))
+
+
+def run_isolated_case(
+    language: str, lines: int, shared: bool, tags: bool
+) -> Dict[str, Any]:
+    """`run_case` in a fresh process, so that the peak memory of the UI is
+    that of this case alone."""
+    context = get_context("spawn")
+    connection, child_connection = context.Pipe(duplex=False)
+    process = context.Process(
+        target=_case_process,
+        args=(child_connection, language, lines, shared, tags),
+    )
+    process.start()
+    child_connection.close()
+    try:
+        return connection.recv()
+    finally:
+        process.join()
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_case(case: Dict[str, Any], previous: Optional[Dict[str, Any]]):
+    def field(phase: str, key: str, unit: float = 1000) -> str:
+        value = case[phase].get(key)
+        if value is None:
+            return "-"
+        text = f"{value * unit:.1f}"
+        if previous is not None and previous[phase].get(key):
+            text += f" ({value / previous[phase][key]:.2f}x)"
+        return text
+
+    print(
+        f"{case['language']:>6} {case['lines']:>7} lines:"
+        f" open {field('open', 'lex_s')} ms"
+        f" / first {field('open', 'first_response_s')} ms"
+        f" / tags {field('open', 'tag_s')} ms"
+        f" / {field('open', 'response_bytes', 1 / 1024)} KiB,"
+        f" edit {field('edit', 'lex_s')} ms"
+        f" / tags {field('edit', 'tag_s')} ms"
+        f" / {field('edit', 'response_bytes', 1 / 1024)} KiB,"
+        f" worker {case['worker_peak_rss_kb']} KiB",
+        file=sys.stderr,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--languages", nargs="+", default=list(CORPORA))
+    parser.add_argument("--lines", nargs="+", type=int, default=list(SIZES))
+    parser.add_argument(
+        "--shared", action="store_true", help="send the text through shared memory"
+    )
+    parser.add_argument(
+        "--no-tags", action="store_true", help="only measure the highlighter"
+    )
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of a previous run")
+    args = parser.parse_args()
+
+    previous: Dict[Tuple[str, int], Dict[str, Any]] = {}
+    if args.compare is not None:
+        with open(args.compare) as f:
+            for case in json.load(f)["cases"]:
+                previous[case["language"], case["lines"]] = case
+
+    cases = []
+    for language in args.languages:
+        for lines in args.lines:
+            case = run_isolated_case(language, lines, args.shared, not args.no_tags)
+            if not args.no_tags and "tag_s" not in case["open"]:
+                print("No display, skipping tag application", file=sys.stderr)
+                args.no_tags = True
+            print_case(case, previous.get((language, lines)))
+            cases.append(case)
+
+    results = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "shared": args.shared,
+        "cases": cases,
+    }
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
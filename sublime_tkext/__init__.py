@@ -32,7 +32,7 @@ from pygments.styles import get_all_styles, get_style_by_name
 from sv_ttk import set_theme
 
 from .highlight import PygmentsHighlighter
-from .lsp import ThreadedLsp
+from .lsp import LspManager
 from .dropdown_menu import CommandPalette, DropdownMenu
 from .editor import Editor
 from .file_explorer import Explorer
@@ -49,7 +49,6 @@ def main(path: Optional[str]) -> None:
     last_state = Config("workspace.json", EditorSavedState).load()
     settings = Config("settings.json", Settings).load()
     color_theme = get_style_by_name("default").styles
-    closed_file_path_buffer = []
 
     # TODO: remove these two variables
     editing_path = Path(os.getcwd() if path is None else path).resolve()
@@ -62,7 +61,8 @@ def main(path: Optional[str]) -> None:
     root.unbind_all("<<PrevWindow>>")
 
     # TODO: Break this whole block out to a function or class
-    lsp = ThreadedLsp(["pylsp"])  # , "-v"])
+    # Servers are started in the workspace once it is opened
+    lsp = LspManager(settings.data.lsp_servers, settings.data.lsp_idle_timeout)
     highlighter = PygmentsHighlighter()
 
     # TODO: set this on open workspace
@@ -168,6 +168,7 @@ def main(path: Optional[str]) -> None:
 
     def open_dir(path: str):
         if os.path.isdir(path):
+            lsp.set_root(path)
             tree.set_directory(path)
             command_frame.set_available_file_dir(path)
             last_state.data.recent_folder_paths.add(path)
@@ -182,6 +183,7 @@ def main(path: Optional[str]) -> None:
                             on_save=reload_settings
                             if fname == settings.path_to_config.as_posix()
                             else None,
+                            lazy=True,
                         )
 
     def open_dir_from_dialog(*_):
@@ -216,13 +218,10 @@ def main(path: Optional[str]) -> None:
         last_state.save()
 
     def close_tab(*_):
-        tab_closed = notebook.close_tab(notebook.select())
-        if tab_closed is not None:
-            closed_file_path_buffer.append(tab_closed)
+        notebook.close_tab(notebook.select())
 
     def reopen_tab(*_):
-        if len(closed_file_path_buffer) > 0:
-            notebook.reopen_tab(closed_file_path_buffer.pop())
+        notebook.reopen_closed_tab()
 
     command_frame.place(relx=0.5, rely=0, anchor="n", width=600)
     app.tkraise()
@@ -248,8 +247,9 @@ def main(path: Optional[str]) -> None:
 
     def on_close(*_):
         update_open_files()
-        if notebook.ensure_all_saved():
-            lsp.process.kill()
+        if notebook.ensure_all_saved() and notebook.flush_saves():
+            lsp.exit()
+            highlighter.close()
             root.destroy()
 
     root.protocol("WM_DELETE_WINDOW", on_close)
@@ -0,0 +1,239 @@
+from dataclasses import dataclass
+import re
+from tkinter import INSERT
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from .dropdown_menu import DropdownMenu
+from .jsonrpc import PendingRequest
+from .lsp import ThreadedLsp, lsp_position, path_to_uri
+from .utils import StackOverflowText, build_query
+
+# Milliseconds without typing after which the server is asked for completions
+COMPLETION_DELAY = 50
+# Completions put in the dropdown, out of all those matching
+MAX_SHOWN = 50
+
+WORD = re.compile(r"\w*$")
+
+
+@dataclass
+class CompletionList:
+    # Line and column where the completed word starts
+    line: int
+    start: int
+    items: List[Dict[str, Any]]
+    # The server has more items for longer words
+    incomplete: bool
+
+
+def filter_items(items: List[Dict[str, Any]], prefix: str) -> List[Dict[str, Any]]:
+    """Items matching `prefix` the way the command palette matches, those
+    starting with it first, in the order of the server."""
+    query = re.compile(build_query(prefix, ".*"))
+    lowered = prefix.lower()
+    matching = []
+    for item in items:
+        text = item.get("filterText") or item["label"]
+        if query.match(text):
+            matching.append(
+                (
+                    not text.lower().startswith(lowered),
+                    item.get("sortText") or item["label"],
+                    item,
+                )
+            )
+    matching.sort(key=lambda match: match[:2])
+    return [item for _, _, item in matching]
+
+
+class Completer:
+    """Completions of the word at the cursor of `text`, shown in `menu`.
+
+    The server is asked once typing pauses, then its items are filtered
+    locally as the word grows or shrinks. It is asked again when the word
+    starts elsewhere, or when it said its items were incomplete. Items are
+    only resolved once they are selected."""
+
+    def __init__(
+        self,
+        text: StackOverflowText,
+        menu: DropdownMenu,
+        server: Callable[[], Optional[ThreadedLsp]],
+        path: Callable[[], Optional[str]],
+    ) -> None:
+        self.text = text
+        self.menu = menu
+        # Server the document is open in, and the path it is open under
+        self.server = server
+        self.path = path
+        self.cache: Optional[CompletionList] = None
+        self.shown: List[Dict[str, Any]] = []
+        self._timer: Optional[str] = None
+        # Ids of the cached items resolved or being resolved
+        self.resolved: Set[int] = set()
+
+        self.menu.on_choose = self.close
+        self.menu.dropdown.bind("<<TreeviewSelect>>", self._resolve_selected)
+
+    @property
+    def provider(self) -> Optional[Dict[str, Any]]:
+        if (server := self.server()) is None or self.path() is None:
+            return None
+        return server.capabilities.get("completionProvider")
+
+    def _word(self) -> Optional[Tuple[int, int, str]]:
+        """Line, start column and text of the word before the cursor, if it
+        is worth completing."""
+        provider = self.provider
+        if provider is None:
+            return None
+        before = self.text.get(f"{INSERT} linestart", INSERT)
+        prefix = WORD.search(before).group(0)  # type: ignore
+        start = len(before) - len(prefix)
+        triggered = start > 0 and before[start - 1] in provider.get(
+            "triggerCharacters", []
+        )
+        if prefix == "" and not triggered:
+            return None
+        return int(self.text.index(INSERT).split(".")[0]), start, prefix
+
+    def update(self, *_):
+        """Show the completions of the word at the cursor."""
+        if (word := self._word()) is None:
+            self.close()
+            return
+        line, start, prefix = word
+        cache = self.cache
+        if cache is not None and (cache.line, cache.start) == (line, start):
+            self._show(prefix)
+            if not cache.incomplete:
+                return
+        self._schedule_request()
+
+    def _schedule_request(self):
+        if self._timer is not None:
+            self.text.after_cancel(self._timer)
+        self._timer = self.text.after(COMPLETION_DELAY, self.request)
+
+    def request(self, *_):
+        if self._timer is not None:
+            self.text.after_cancel(self._timer)
+            self._timer = None
+        # The server has to know about every change before the cursor
+        self.text.flush_changes()
+        if self._timer is not None or (word := self._word()) is None:
+            return
+        line, start, _ = word
+        server, path = self.server(), self.path()
+        if server is None or path is None:
+            return
+        buffer = self.text.buffer
+        cursor = buffer.offset(*(int(i) for i in self.text.index(INSERT).split(".")))
+        server.request(
+            "textDocument/completion",
+            {
+                "textDocument": {"uri": path_to_uri(path)},
+                "position": lsp_position(buffer, cursor),
+            },
+            callback=lambda future: self._on_completions(future, line, start),
+            supersede=True,
+        )
+
+    def _on_completions(self, future: PendingRequest, line: int, start: int):
+        if future.exception() is not None:
+            return
+        result = future.result()
+        if isinstance(result, dict):
+            items, incomplete = result.get("items", []), result.get("isIncomplete")
+        else:
+            items, incomplete = result or [], False
+        self.cache = CompletionList(line, start, items, bool(incomplete))
+        self.resolved.clear()
+        word = self._word()
+        if word is not None and word[:2] == (line, start):
+            self._show(word[2])
+
+    def _show(self, prefix: str):
+        assert self.cache is not None
+        self.shown = filter_items(self.cache.items, prefix)[:MAX_SHOWN]
+        if len(self.shown) == 0:
+            self.close()
+            return
+        self.menu.set_choices(
+            [
+                (
+                    (item["label"], item.get("detail") or ""),
+                    lambda _, item=item: self.accept(item),
+                )
+                for item in self.shown
+            ]
+        )
+        self.menu.select_first()
+        if not self.menu.winfo_ismapped():
+            self.menu.pack()
+            pos = self.text.bbox(INSERT)
+            if pos is None:
+                return
+            self.menu.place(x=pos[0], y=pos[1] + pos[3], anchor="nw")
+            self.text.up_down_disable()
+
+    def is_open(self) -> bool:
+        return self.menu.winfo_ismapped()
+
+    def close(self, *_):
+        if self._timer is not None:
+            self.text.after_cancel(self._timer)
+            self._timer = None
+        self.cache = None
+        self.shown = []
+        self.resolved.clear()
+        self.menu.place_forget()
+        self.text.up_down_enable()
+
+    def selected(self) -> Optional[Dict[str, Any]]:
+        focus = self.menu.dropdown.focus()
+        if focus == "":
+            return None
+        index = self.menu.dropdown.index(focus)
+        return self.shown[index] if index < len(self.shown) else None
+
+    def accept(self, item: Optional[Dict[str, Any]] = None):
+        """Replace the word before the cursor with `item`, by default the
+        selected one."""
+        if item is None and (item := self.selected()) is None:
+            return
+        if "textEdit" in item:
+            # Only the text is used, the edit is assumed to span the word
+            new_text = item["textEdit"]["newText"]
+        else:
+            new_text = item.get("insertText") or item["label"]
+        if self.cache is not None:
+            self.text.replace(f"{self.cache.line}.{self.cache.start}", INSERT, new_text)
+        self.close()
+
+    def _resolve_selected(self, *_):
+        provider = self.provider
+        if (
+            (server := self.server()) is None
+            or provider is None
+            or not provider.get("resolveProvider")
+            or (item := self.selected()) is None
+            or id(item) in self.resolved
+        ):
+            return
+        self.resolved.add(id(item))
+        iid = self.menu.dropdown.focus()
+
+        def on_resolved(future: PendingRequest):
+            if future.exception() is not None:
+                return
+            item.update(future.result())
+            if self.menu.dropdown.exists(iid) and self.selected() is item:
+                self.menu.dropdown.item(iid, values=(item.get("detail") or "",))
+
+        server.request(
+            "completionItem/resolve",
+            item,
+            callback=on_resolved,
+            supersede=True,
+        )
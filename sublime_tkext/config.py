@@ -69,9 +69,34 @@ class Settings(Dictable):
     editor_font_ligatures: bool = True
     # TODO: support minimap
     editor_minimap_enabled: bool = True
-    # TODO: support line numbers
+    # Absolute or relative to the line of the cursor
     editor_line_numbers: Literal["on", "off", "relative"] = "on"
+    # Only re-lex from the edited line instead of the whole document
+    editor_incremental_highlighting: bool = True
+    # Send large documents to the highlighter through shared memory
+    editor_highlight_shared_memory: bool = True
     files_insert_final_newline: bool = True
+    # Files of at least this many bytes are loaded in chunks, without undo
+    # and highlighting
+    files_large_file_size: int = 64 * 1024 * 1024
+    # Only keep the part of large files around the viewport in the editor,
+    # read-only
+    files_large_file_mmap: bool = False
+    # Tabs restored with a workspace are loaded when first selected, and
+    # this many on each side of the selected tab are loaded while idle
+    files_prefetch_tabs: int = 1
+    # Closed tabs kept alive to be reopened quickly, as long as their text
+    # fits in this many bytes. Older ones are reopened from disk.
+    files_closed_tabs_kept: int = 4
+    files_closed_tabs_memory: int = 32 * 1024 * 1024
+    # Command of the language server of every language, started with the
+    # first document of that language
+    lsp_servers: Dict[str, List[str]] = dataclasses.field(
+        default_factory=lambda: {"python": ["pylsp"]}
+    )
+    # Seconds after the last document of a language server is closed after
+    # which the server is shut down
+    lsp_idle_timeout: float = 300
     font_size: int = 12
     tab_size: int = 4
     line_numbers: bool = True
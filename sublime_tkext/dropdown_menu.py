@@ -46,8 +46,8 @@ class DropdownMenu(Frame):
         selected_text = self.dropdown.item(current := self.dropdown.focus(), "text")
         selected_values = self.dropdown.item(current, "values")
 
-        if selected_text in self.callbacks.keys():
-            self.callbacks[selected_text]((selected_text, *selected_values))
+        if current in self.callbacks.keys():
+            self.callbacks[current]((selected_text, *selected_values))
 
         self.dropdown.delete(*self.dropdown.get_children(current))  # type: ignore
 
@@ -64,20 +64,37 @@ class DropdownMenu(Frame):
             choices = list(cmd for cmd in choices if filter.match(cmd[0][0]))
 
         self.dropdown.delete(*self.dropdown.get_children())
+        self.callbacks = {}
         for choice, callback in choices:
-            self.dropdown.insert(
-                self.dropdown.insert(
-                    "",
-                    "end",
-                    text=choice[0],
-                    values=choice[1:] if len(choice) > 1 else [],
-                    open=False,
-                ),
+            item = self.dropdown.insert(
+                "",
                 "end",
+                text=choice[0],
+                values=choice[1:] if len(choice) > 1 else [],
+                open=False,
             )
-            self.callbacks[choice[0]] = callback
+            self.dropdown.insert(item, "end")
+            # Labels can repeat, so callbacks go by item
+            self.callbacks[item] = callback
         self.dropdown.configure(height=min(len(choices), MAX_ITEMS))
 
+    def select_first(self):
+        tabs = self.dropdown.get_children()
+        if len(tabs) > 0:
+            self.dropdown.focus(tabs[0])
+        self.dropdown.selection_set(self.dropdown.focus())
+
+    def move_selection(self, step: int):
+        tabs = self.dropdown.get_children()
+        if len(tabs) > 0:
+            focus = self.dropdown.focus()
+            # Without a focused item, down goes to the first and up to the last
+            index = self.dropdown.index(focus) if focus != "" else -(step > 0)
+            index += step
+            self.dropdown.focus(tabs[index % len(tabs)])
+            self.dropdown.see(self.dropdown.focus())
+        self.dropdown.selection_set(self.dropdown.focus())
+
     def pack(self, *args, **kwargs):
         super().pack(*args, **kwargs)
         self.scroll.pack(side="right", fill="y")
@@ -106,18 +123,10 @@ class CommandPalette(DropdownMenu):
         super().pack()
 
         def on_up(*_):
-            up_one = self.dropdown.prev(self.dropdown.focus())
-            tabs = self.dropdown.get_children()
-            if len(tabs) > 0:
-                self.dropdown.focus(up_one if up_one != "" else tabs[-1])
-            self.dropdown.selection_set(self.dropdown.focus())
+            self.move_selection(-1)
 
         def on_down(*_):
-            down_one = self.dropdown.next(self.dropdown.focus())
-            tabs = self.dropdown.get_children()
-            if len(tabs) > 0:
-                self.dropdown.focus(down_one if down_one != "" else tabs[0])
-            self.dropdown.selection_set(self.dropdown.focus())
+            self.move_selection(1)
 
         def on_filter_change(*_):
             if len(self.command.get()) > 0:
@@ -131,7 +140,7 @@ class CommandPalette(DropdownMenu):
                             if filter.match(cmd[0][0])
                         )
                     )
-                    self._select_first()
+                    self.select_first()
                     return
                 # TODO: Line number
                 elif self.command.get()[0] == ":":
@@ -144,7 +153,7 @@ class CommandPalette(DropdownMenu):
                     self.set_choices(
                         [((f"Line {l}: character {c}",), on_choose_location)]
                     )
-                    self._select_first()
+                    self.select_first()
                     return
             # Filter list of files in workspace
             if self.available_file_dir is not None:
@@ -165,7 +174,7 @@ class CommandPalette(DropdownMenu):
                         if f.is_file()
                     )
                 )
-                self._select_first()
+                self.select_first()
             return
 
         self.entry.bind(
@@ -182,18 +191,12 @@ class CommandPalette(DropdownMenu):
         self.dropdown.column("#0", width=300)
         self.dropdown.column("keybinds", anchor=E)
 
-    def _select_first(self):
-        tabs = self.dropdown.get_children()
-        if len(tabs) > 0:
-            self.dropdown.focus(tabs[0])
-        self.dropdown.selection_set(self.dropdown.focus())
-
     def open(self, prefix=""):
         self.tkraise()
         self.command.set(prefix)
         self.entry.icursor(self.entry.index(INSERT) + 1)
         self.entry.focus_set()
-        self._select_first()
+        self.select_first()
 
     def add_available_command(self, command: Tuple[Tuple[str, ...], Callback]):
         self.available_commands.append(command)
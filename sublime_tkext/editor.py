@@ -1,18 +1,59 @@
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from hashlib import blake2b
 import os
-from tkinter.font import Font
 from rich import print
-import string
-from tkinter import E, END, INSERT, TOP, PhotoImage, StringVar, Text
+import time
+from tkinter import E, END, INSERT, READABLE, TOP, PhotoImage, StringVar, Text
 from tkinter.filedialog import asksaveasfilename
-from tkinter.messagebox import askyesnocancel
+from tkinter.messagebox import askyesnocancel, showerror
 from tkinter.ttk import Button, Entry, Frame, Notebook, Scrollbar
-from typing import Any, Dict, List, Optional, Tuple, Union
+from typing import IO, Any, Callable, Deque, Dict, List, Optional, Tuple, Union
 
-from .highlight import PygmentsHighlighter, TagInfo, parse_style_string, parse_styles
-from .lsp import ThreadedLsp
+from .highlight import HighlightResponse, PygmentsHighlighter, Tokens
+from .large_file import LOAD_CHUNK_SIZE, MappedFile
+from .styles import StyleRegistry
+from .lsp import LspManager, ThreadedLsp, lsp_position
+from .completion import Completer
 from .config import Settings
 from .dropdown_menu import DropdownMenu
-from .utils import Callback, StackOverflowText, TextLineNumbers, iter_except
+from .piece_table import PieceTable
+from .saver import FileSaver, SaveRequest, SaveResult
+from .utils import (
+    Callback,
+    SelfPipe,
+    StackOverflowText,
+    TextLineNumbers,
+    iter_except,
+    offsets_to_indices,
+)
+
+# Milliseconds without edits after which the text of a document is hashed
+HASH_DELAY = 500
+
+# Seconds spent handling messages before letting Tk process other events
+PUMP_BUDGET = 0.01
+# Milliseconds between checks for messages where Tk can't watch files
+PUMP_INTERVAL = 40
+
+# Milliseconds between checks for idle language servers
+LSP_IDLE_CHECK = 10_000
+
+# Closed tabs that can be reopened, live or not
+CLOSED_TABS = 64
+
+# Hashes the text of documents to compare them with the files on disk
+_hasher = ThreadPoolExecutor(max_workers=1)
+
+
+def _path_key(path: str) -> str:
+    return os.path.normcase(os.path.realpath(path))
+
+
+def _hash_text(text: PieceTable) -> bytes:
+    return blake2b(text.text().encode("utf-8", "surrogatepass")).digest()
+
 
 # Popups:
 # info_window.bind_all("<Leave>", lambda e: info_window.destroy())
@@ -26,9 +67,13 @@ class Document(Frame):
         tab_name: StringVar,
         settings: Settings,
         highlighter: PygmentsHighlighter,
+        saver: FileSaver,
+        lsp: Optional[LspManager] = None,
         path: Optional[str] = None,
-        theme: Optional[Dict[object, str]] = None,
+        styles: Optional[StyleRegistry] = None,
         on_save: Optional[Callback] = None,
+        on_rename: Optional[Callback] = None,
+        lazy: bool = False,
         **kwargs,
     ):
         super().__init__(*args, **kwargs)
@@ -37,10 +82,58 @@ class Document(Frame):
 
         self.tab_name = tab_name
         self.on_save = on_save
+        # Called with the document and its previous path when its path changes
+        self.on_rename = on_rename
         self.highlighter = highlighter
+        self.saver = saver
+        self.lsp = lsp
 
         self.hidden = False
 
+        # Highlighting language, guessed from the path or content when None
+        self.language: Optional[str] = None
+        # Bumped on every edit so that outdated highlighting can be dropped
+        self.version = 0
+        self.highlighted_version = -1
+
+        # Large files are loaded in chunks, or only around the viewport
+        self.large_file = False
+        self._loader: Optional[str] = None
+        self._loading_file: Optional[IO[str]] = None
+        self._mapped: Optional[MappedFile] = None
+        # Byte range and first line of the part of a mapped file shown
+        self._window = (0, 0)
+        self._window_line = 1
+        self._recenter_pending = False
+
+        # Size, mtime and text hash of the file when it was loaded or saved
+        self._disk_state: Optional[Tuple[int, int, "Future[bytes]"]] = None
+        self._text_hash: Optional["Future[bytes]"] = None
+        self._hash_timer: Optional[str] = None
+        # Why the latest save failed, until the next one
+        self.save_error: Optional[str] = None
+
+        # Language server the document is open in, the text it has, and the
+        # path it has it under
+        self._lsp_server: Optional[ThreadedLsp] = None
+        self._lsp_text: Optional[PieceTable] = None
+        self._lsp_path: Optional[str] = None
+
+        self.styles = styles
+        self._styles_revision: Optional[int] = None
+
+        # Lazy documents only build their widgets and load their file once
+        # they are first shown
+        self.materialized = False
+        if not lazy:
+            self.materialize()
+
+    def materialize(self):
+        if self.materialized:
+            return
+        self.materialized = True
+        settings = self.settings
+
         self.content = StackOverflowText(
             self,
             undo=True,
@@ -50,24 +143,15 @@ class Document(Frame):
             pady=10,
             borderwidth=0,
         )
-        # self.line_numbers = Text(
-        #     self,
-        #     width=4,
-        #     takefocus=0,
-        #     font=(settings.editor_font_family, settings.editor_font_size),
-        #     padx=10,
-        #     pady=10,
-        #     borderwidth=0,
-        # )
-        # TODO: fix line numbers
-        # self.line_numbers = TextLineNumbers(
-        #     self,
-        #     textwidget=self.content,
-        #     width=8,
-        #     takefocus=0,
-        #     borderwidth=2,
-        # )
-        # self.old_line_count = 0
+        self.line_numbers = TextLineNumbers(
+            self,
+            textwidget=self.content,
+            mode=settings.editor_line_numbers,
+            takefocus=0,
+            borderwidth=0,
+            highlightthickness=0,
+            background=self.content.cget("background"),
+        )
         self.scroll = Scrollbar(self)
 
         # def yview(*_):
@@ -75,75 +159,51 @@ class Document(Frame):
         #     self.line_numbers.yview(*_)
 
         self.scroll.config(command=self.content.yview)
-        self.content.configure(yscrollcommand=self.scroll.set)
-        # self.line_numbers.configure(yscrollcommand=self.scroll.set)
-        # self.content.bind(
-        #     "<<Scroll>>",
-        #     lambda e: self.line_numbers.yview_moveto(self.content.yview()[0]),
-        # )
+        self.content.configure(yscrollcommand=self._on_yscroll)
+        self._viewport: Optional[Tuple[int, int]] = None
+        self._viewport_update_pending = False
         self.autocomplete = DropdownMenu(
             self, on_choose=print, columns=("description",)
         )
         self.autocomplete.dropdown.column("description", anchor=E)
+        self.completer = Completer(
+            self.content,
+            self.autocomplete,
+            lambda: self._lsp_server,
+            lambda: self._lsp_path,
+        )
 
         self.find = StringVar()
 
         self.entry = Entry(self, width=48, textvariable=self.find)
 
-        self.theme = theme
-        if theme is not None:
-            self.update_theme(theme)
-
-        def open_dropdown(*_):
-            # TODO: Send request to LSP here
-            self.autocomplete.pack()
-            self.autocomplete.set_choices(
-                [
-                    (("print", ""), print),
-                    (("print_function", "__future__"), print),
-                ]
-            )
-
-            pos = self.content.bbox("insert")
-            if pos is not None:
-                self.autocomplete.place(x=pos[0], y=pos[1] + pos[3], anchor="nw")
-                self.content.up_down_disable()
-
-        def close_dropdown(*_):
-            self.autocomplete.place_forget()
-            self.content.up_down_enable()
-
-        def should_autocomplete():
-            return not self.content.get("insert-1c") in string.whitespace
+        self.apply_styles()
 
         def open_search(*_):
             print("open search")
 
         def on_text_deleted(*_):
-            if should_autocomplete() and self.autocomplete.winfo_ismapped():
-                open_dropdown()
-            else:
-                close_dropdown()
+            if self.completer.is_open():
+                self.completer.update()
 
         def on_text_inserted(*_):
-            if should_autocomplete():
-                open_dropdown()
-            else:
-                close_dropdown()
+            self.completer.update()
+
+        def on_completion_key(action):
+            def handler(*_):
+                if not self.completer.is_open():
+                    return None
+                action()
+                return "break"
+
+            return handler
 
         def on_text_modified(*_):
             self._mark_modified()
-            self.highlighter.send_highlight_request(
-                code=self.content.get("1.0", "end - 1c"), file_identifier=self.path
-            )  # TODO: This line causes slowdown...
-            # self.line_numbers.redraw()
-            # new_line_count = int(self.content.index("end-1c").split(".")[0])
-            # while self.old_line_count < new_line_count:
-            #     self.line_numbers.insert("end", str(self.old_line_count + 1) + "\n")
-            #     self.old_line_count += 1
-            # while self.old_line_count > new_line_count:
-            #     self.line_numbers.delete("end-2c", "end")
-            #     self.old_line_count -= 1
+            self.request_highlight()
+            self._send_lsp_changes()
+            self._schedule_text_hash()
+            self.line_numbers.redraw()
 
         def on_move(*_):
             old_position = self.content.index("insert")
@@ -152,135 +212,578 @@ class Document(Frame):
         self.content.bind("<<TextInserted>>", on_text_inserted)
         # self.content.bind("<<TextReplaced>>", on_text_replaced)
         self.content.bind("<<TextModified>>", on_text_modified)
+        self.content.bind("<<CursorMoved>>", self.completer.close)
+        self.content.bind("<<CursorMoved>>", self.line_numbers.redraw, add=True)
+        self.content.bind("<Configure>", self.line_numbers.redraw, add=True)
+        self.content.bind("<Control-space>", self.completer.request)
+        self.content.bind(
+            "<Up>", on_completion_key(lambda: self.autocomplete.move_selection(-1))
+        )
         self.content.bind(
-            "<<CursorMoved>>", close_dropdown
-        )  # TODO: Up/Down should navigate through the dropdown, left right should sometimes close it
-        # self.content.bind("<<Change>>", lambda *_: self.line_numbers.redraw())
-        self.content.bind("<Control-space>", open_dropdown)
+            "<Down>", on_completion_key(lambda: self.autocomplete.move_selection(1))
+        )
+        self.content.bind("<Tab>", on_completion_key(self.completer.accept))
+        self.content.bind("<Return>", on_completion_key(self.completer.accept))
         # TODO: ctrl-f should open a search bar
         self.content.bind("<Control-f>", open_search)
-        self.content.bind("<Escape>", close_dropdown)
+        self.content.bind("<Escape>", self.completer.close)
         self.content.bind("<Control-s>", lambda *_: self.save())
 
-        if path is not None:
-            self.load(path)
+        if self.path is not None:
+            self.load(self.path)
         # TODO: bind ctrl-shift-s save as
         # TODO: Do multiple cursors using tags
         self.scroll.pack(side="right", fill="y")
+        if settings.editor_line_numbers != "off":
+            self.line_numbers.pack(side="left", fill="y")
         self.content.pack(side="right", fill="both", expand=True)
-        # self.line_numbers.pack(side="right", fill="both", expand=True)
 
-        super().pack(fill="both", expand=True)
+    def request_highlight(self):
+        self.version += 1
+        if self.large_file and self._mapped is None:
+            return
+        self.highlighter.send_highlight_request(
+            code=self.content.buffer.text(),
+            file_identifier=self.file_id,
+            path=self.path,
+            language=self.language,
+            incremental=self.settings.editor_incremental_highlighting,
+            version=self.version,
+            applied_version=self.highlighted_version,
+            viewport=self.visible_lines(),
+            # The first highlight of a document can go to any idle worker
+            bulk=self.version == 1,
+            shared=self.settings.editor_highlight_shared_memory,
+        )
+
+    def visible_lines(self) -> Tuple[int, int]:
+        first = int(self.content.index("@0,0").split(".")[0])
+        last = int(
+            self.content.index(f"@0,{self.content.winfo_height()}").split(".")[0]
+        )
+        return first, last
+
+    def _on_yscroll(self, first, last):
+        self.line_numbers.redraw()
+        if self._mapped is None:
+            self.scroll.set(first, last)
+        else:
+            # The scrollbar spans the whole file, not just the window
+            start, end = self._window
+            size = max(self._mapped.size, 1)
+            self.scroll.set(
+                (start + float(first) * (end - start)) / size,
+                (start + float(last) * (end - start)) / size,
+            )
+            near_start = float(first) < 0.25 and start > 0
+            near_end = float(last) > 0.75 and end < self._mapped.size
+            if (near_start or near_end) and not self._recenter_pending:
+                self._recenter_pending = True
+                self.after_idle(self._recenter)
+        if not self._viewport_update_pending:
+            self._viewport_update_pending = True
+            self.after_idle(self._send_viewport)
+
+    def _send_viewport(self):
+        # Lets the highlighter lex what just scrolled into view first
+        self._viewport_update_pending = False
+        viewport = self.visible_lines()
+        if viewport != self._viewport:
+            self._viewport = viewport
+            self.highlighter.send_viewport(self.file_id, *viewport)
+
+    def is_highlight_current(self, version: int) -> bool:
+        # Edits not dispatched yet have not bumped the version
+        return version >= self.version and len(self.content.pending_changes) == 0
 
     def _mark_modified(self):
-        # TODO: this sometimes marks the wrong tab modified and renames the rightmost tab??
         self.tab_name.set(self.tab_name.get().rstrip(" *") + " *")
 
     def _mark_saved(self):
         self.tab_name.set(self.tab_name.get().rstrip(" *") + "  ")
 
+    @property
+    def file_id(self) -> str:
+        """Identifies the document to the highlighter, even across renames."""
+        return str(self)
+
     @property
     def path(self) -> Optional[str]:
         return self._path
 
     @path.setter
     def path(self, path: Optional[str]) -> None:
-        self._path = path
+        previous, self._path = self._path, path
         if path is not None:
             self.tab_name.set(os.path.basename(path))
+        if path != previous and self.on_rename is not None:
+            self.on_rename(self, previous)
 
     def load(self, path: Optional[str]):
+        self.close_in_lsp()
+        self._close_large_file()
+        self.large_file = (
+            path is not None
+            and os.path.getsize(path) >= self.settings.files_large_file_size
+        )
+        self.content.config(undo=not self.large_file)
         self.content.delete("1.0", "end")
+        if self.large_file:
+            self.content.discard_changes()
+            self.content.edit_reset()
+            if self.settings.files_large_file_mmap:
+                self._open_mapped(path)  # type: ignore
+            else:
+                self._stream(path)  # type: ignore
+            return
         if path is not None:
             with open(path, "r") as f:
                 self.content.insert("1.0", f.read())
+        self.content.flush_changes()
         self.content.edit_modified(False)
         self._mark_saved()
         self.content.edit_reset()
         self.path = path
-
-    def ask_then_save(self) -> bool:
-        result = askyesnocancel(
+        self._record_disk_state()
+        self.open_in_lsp()
+
+    def _stream(self, path: str):
+        """Load `path` one chunk per event loop iteration, showing the
+        progress in the tab name."""
+        f = self._loading_file = open(path, "r")
+        size = max(os.path.getsize(path), 1)
+        # Edits are only possible once the whole file is loaded
+        self.content.config(state="disabled")
+
+        def load_chunk():
+            chunk = f.read(LOAD_CHUNK_SIZE)
+            if chunk == "":
+                f.close()
+                self._loader = self._loading_file = None
+                self.content.config(state="normal")
+                self.content.edit_modified(False)
+                self.path = path
+                self._mark_saved()
+                self._record_disk_state()
+                return
+            self.content.config(state="normal")
+            self.content.insert("end", chunk)
+            self.content.config(state="disabled")
+            self.content.discard_changes()
+            progress = 100 * f.buffer.tell() // size
+            self.tab_name.set(f"{os.path.basename(path)} {progress}%  ")
+            self._loader = self.after(1, load_chunk)
+
+        self._loader = self.after_idle(load_chunk)
+
+    def _open_mapped(self, path: str):
+        self._mapped = MappedFile(path)
+        self.scroll.config(command=self._scroll_mapped)
+        self.path = path
+        self._mark_saved()
+        self._show_window(0, 1)
+
+    def _show_window(self, offset: int, top_line: int):
+        """Replace the text with the lines of the mapped file around `offset`,
+        scrolled to the 1-based `top_line` of the file."""
+        assert self._mapped is not None
+        start, end = self._window = self._mapped.window(offset)
+        self._window_line = self._mapped.line_of(start)
+        self.line_numbers.line_offset = self._window_line - 1
+        text = self._mapped.text(start, end).replace("\r\n", "\n")
+        if end < self._mapped.size and text.endswith("\n"):
+            # Tk adds the final newline itself
+            text = text[:-1]
+        self.content.config(state="normal")
+        self.content.delete("1.0", "end")
+        self.content.insert("1.0", text)
+        self.content.config(state="disabled")
+        self.content.discard_changes()
+        self.content.edit_modified(False)
+        self.content.yview(f"{top_line - self._window_line + 1}.0")
+        self.request_highlight()
+
+    def _recenter(self):
+        self._recenter_pending = False
+        if self._mapped is None:
+            return
+        top_line = self._window_line + self.visible_lines()[0] - 1
+        self._show_window(self._mapped.line_offset(top_line), top_line)
+
+    def _scroll_mapped(self, *args):
+        assert self._mapped is not None
+        if args[0] != "moveto":
+            self.content.yview(*args)
+            return
+        offset = int(float(args[1]) * self._mapped.size)
+        start, end = self._window
+        if start <= offset < end:
+            self.content.yview_moveto((offset - start) / (end - start))
+        else:
+            offset = min(max(offset, 0), max(self._mapped.size - 1, 0))
+            self._show_window(offset, self._mapped.line_of(offset))
+
+    def _close_large_file(self):
+        if self._loader is not None:
+            self.after_cancel(self._loader)
+            self._loader = None
+        if self._loading_file is not None:
+            self._loading_file.close()
+            self._loading_file = None
+        if self._mapped is not None:
+            self._mapped.close()
+            self._mapped = None
+            self.line_numbers.line_offset = 0
+            self.scroll.config(command=self.content.yview)
+        self.content.config(state="normal")
+
+    def view(self) -> Tuple[str, float]:
+        """Cursor and scroll position, to be restored with `restore_view`."""
+        if not self.materialized:
+            return "1.0", 0.0
+        return self.content.index(INSERT), self.content.yview()[0]
+
+    def restore_view(self, cursor: str, yview: float):
+        self.content.mark_set(INSERT, cursor)
+        self.content.yview_moveto(yview)
+
+    def open_in_lsp(self):
+        """Open the document in the language server, which is then kept in
+        sync with every change."""
+        # Changes made before are not part of what the server gets
+        self.content.flush_changes()
+        self.close_in_lsp()
+        if (
+            self.lsp is None
+            or self.path is None
+            or self.large_file
+            or (server := self.lsp.server_for(self.path)) is None
+        ):
+            return
+        self._lsp_server = server
+        self._lsp_text = self.content.buffer.snapshot()
+        self._lsp_path = self.path
+        server.send_did_open_noti(self.path, self._lsp_text.text())
+
+    def close_in_lsp(self):
+        if self._lsp_server is not None and self._lsp_path is not None:
+            self._lsp_server.send_did_close_noti(self._lsp_path)
+        self._lsp_server = self._lsp_text = self._lsp_path = None
+
+    def _send_lsp_changes(self):
+        if self._lsp_server is None or self._lsp_text is None or self._lsp_path is None:
+            return
+        # Every change is relative to the text after the previous ones, which
+        # the server applies in order too
+        text = self._lsp_text.snapshot()
+        changes = []
+        for change in self.content.changes:
+            changes.append(
+                {
+                    "range": {
+                        "start": lsp_position(text, change.start),
+                        "end": lsp_position(text, change.end),
+                    },
+                    "text": change.text,
+                }
+            )
+            text.delete(change.start, change.end)
+            text.insert(change.start, change.text)
+        if len(changes) == 0:
+            return
+        self._lsp_text = text
+        self._lsp_server.send_did_change_noti(self._lsp_path, changes, text.snapshot())
+
+    def destroy(self):
+        if self.materialized:
+            self.close_in_lsp()
+            self._close_large_file()
+        if self._hash_timer is not None:
+            self.after_cancel(self._hash_timer)
+            self._hash_timer = None
+        super().destroy()
+
+    def ask_to_save(self) -> Optional[bool]:
+        """Whether the user wants the changes saved, None if they cancelled."""
+        return askyesnocancel(
             title="Sublime Tkext",
             message=f"Do you want to save the changes you made{' to ' + os.path.basename(self.path) if self.path is not None else ''}?",
         )
-        if result is None:
-            return False
-        elif result is True:
-            return self.save()
-        return True
 
     def save(self) -> bool:
+        if self._mapped is not None or self._loader is not None:
+            # Read-only, or not loaded yet
+            return True
         if self.path is not None:
-            try:
-                f = open(self.path, "w")
-                f.write(self.content.get("1.0", "end-1c"))
-                self.content.edit_modified(False)
-                self._mark_saved()
-                f.close()
-                if self.on_save is not None:
-                    self.on_save()
-                return True
-            except Exception:
-                return False
+            # Written on the saver's thread, which reports back to on_saved
+            self.save_error = None
+            self.saver.save(
+                SaveRequest(
+                    path=self.path,
+                    text=self.content.buffer.snapshot(),
+                    file_id=self.file_id,
+                    version=self.version,
+                )
+            )
+            return True
         else:
             return self.save_as()
 
+    def on_saved(self, result: SaveResult):
+        if result.error is not None:
+            print(f"Failed to save {result.request.path}: {result.error}")
+            self.save_error = result.error
+            return
+        if result.request.path != self.path:
+            # Saved as another file since
+            return
+        text_hash = _hasher.submit(_hash_text, result.request.text)
+        self._disk_state = (result.size, result.mtime_ns, text_hash)
+        if self._lsp_server is not None and self._lsp_path == self.path:
+            self._lsp_server.send_did_save_noti(self.path)
+        if result.request.version == self.version:
+            self._text_hash = text_hash
+            self.content.edit_modified(False)
+            self._mark_saved()
+        if self.on_save is not None:
+            self.on_save()
+
     def save_as(self) -> bool:
         try:
             path = asksaveasfilename()
             if path != "":
                 self.path = path
+                self.open_in_lsp()
                 return self.save()
         except Exception:
             ...
         return False
 
+    def _schedule_text_hash(self):
+        # The hash is computed once typing pauses, on another thread
+        self._text_hash = None
+        if self._hash_timer is not None:
+            self.after_cancel(self._hash_timer)
+        self._hash_timer = self.after(HASH_DELAY, self._current_text_hash)
+
+    def _current_text_hash(self) -> "Future[bytes]":
+        if self._hash_timer is not None:
+            self.after_cancel(self._hash_timer)
+            self._hash_timer = None
+        if self._text_hash is None:
+            # Snapshots never change, so they can be hashed on another thread
+            self._text_hash = _hasher.submit(_hash_text, self.content.buffer.snapshot())
+        return self._text_hash
+
+    def _record_disk_state(self):
+        if self.path is None:
+            self._disk_state = None
+            return
+        stat = os.stat(self.path)
+        # Loading in chunks does not go through on_text_modified
+        self._text_hash = None
+        self._disk_state = (stat.st_size, stat.st_mtime_ns, self._current_text_hash())
+
     def is_different_from_disk(self) -> bool:
+        if self._mapped is not None or self._loader is not None:
+            return False
         if self.path is None:
-            return self.content.get("1.0", "end - 1c") != ""
-        with open(self.path, "r") as f:
-            return f.read() != self.content.get("1.0", "end - 1c")
+            return len(self.content.buffer) > 0
+        if self._disk_state is None:
+            return True
+        size, mtime_ns, disk_hash = self._disk_state
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return True
+        if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+            # Changed on disk since it was loaded or saved
+            return True
+        return self._current_text_hash().result() != disk_hash.result()
 
     def update_settings(self, settings: "Settings"):
         self.settings = settings
+        if not self.materialized:
+            return
         self.content.config(
             font=(settings.editor_font_family, settings.editor_font_size)
         )
-        # self.line_numbers.config(
-        #     font=(settings.editor_font_family, settings.editor_font_size)
-        # )
-        # self.line_numbers.update_textwidget(self.content)
-
-    def update_theme(self, theme: Dict[object, str]):
-        self.theme = theme
-        flattened_theme = parse_styles(theme)  # type: ignore
-        for k, v in flattened_theme.items():
+        self.apply_styles()
+        self.line_numbers.set_mode(settings.editor_line_numbers)
+        self.line_numbers.update_font()
+        if settings.editor_line_numbers == "off":
+            self.line_numbers.pack_forget()
+        elif self.line_numbers.winfo_manager() == "":
+            self.line_numbers.pack(side="left", fill="y", before=self.content)
+
+    def apply_styles(self):
+        # Tags only need reconfiguring when the shared styles changed since they were
+        # last applied
+        if (
+            not self.materialized
+            or self.styles is None
+            or self._styles_revision == self.styles.revision
+        ):
+            return
+        self._styles_revision = self.styles.revision
+        for k, v in self.styles.records.items():
             self.content.tag_config(
                 k,
-                foreground=v["foreground"],
-                background=v["background"],
-                font=Font(
-                    family=self.settings.editor_font_family,
-                    size=self.settings.editor_font_size,
-                    weight="bold" if v["bold"] == True else "normal",
-                    slant="italic" if v["italic"] == True else "roman",
-                    underline=v["underline"] == True,
-                ),
+                foreground=v.foreground,
+                background=v.background,
+                font=self.styles.font(v),
             )
         self.content.tag_config(
             "sel",
             background="#2f2f2f",
         )
 
-    def update_tags(self, tags: List[TagInfo]):
-        self.content.tag_delete(*self.content.tag_names()[1:])
-        for tag in tags:
-            self.content.tag_add(
-                tag.tag, f"1.0 + {tag.start} chars", f"1.0 + {tag.end} chars"
+    def update_tags(
+        self, tokens: Tokens, tag_names: List[str], start: int = 0, end: int = -1
+    ):
+        """Replace the highlighting of the `start`-`end` character range.
+
+        Only the ranges that differ from the tags already in the widget are
+        removed or added, with one Tcl call per tag name."""
+        buffer = self.content.buffer
+        end = len(buffer) if end < 0 else min(end, len(buffer))
+        start_index, end_index = buffer.index(start), buffer.index(end)
+        line, col = buffer.position(start)
+        indices = iter(
+            offsets_to_indices(
+                buffer.slice(start, end),
+                line,
+                col,
+                (
+                    offset - start
+                    for token_start, length in zip(tokens.starts, tokens.lengths)
+                    for offset in (token_start, token_start + length)
+                ),
             )
-        if self.theme is not None:
-            self.update_theme(self.theme)
+        )
+
+        wanted: Dict[str, List[Tuple[str, str]]] = {}
+        for tag_id, first, last in zip(tokens.tag_ids, indices, indices):
+            ranges = wanted.setdefault(tag_names[tag_id], [])
+            if len(ranges) > 0 and ranges[-1][1] == first:
+                ranges[-1] = (ranges[-1][0], last)
+            else:
+                ranges.append((first, last))
+
+        applied: Dict[str, List[Tuple[str, str]]] = {}
+        open_tags = {
+            name: start_index
+            for name in self.content.tag_names(start_index)
+            if name.startswith("Token")
+        }
+        for key, name, index in self.content.dump(start_index, end_index, tag=True):
+            if not name.startswith("Token"):
+                continue
+            if key == "tagon":
+                open_tags[name] = index
+            elif key == "tagoff":
+                applied.setdefault(name, []).append(
+                    (open_tags.pop(name, start_index), index)
+                )
+        for name, index in open_tags.items():
+            if index != end_index:
+                applied.setdefault(name, []).append((index, end_index))
+
+        for name in applied.keys() | wanted.keys():
+            old = set(applied.get(name, []))
+            new = set(wanted.get(name, []))
+            if len(removed := old - new) > 0:
+                self.content.tk.call(
+                    self.content._w,  # type: ignore
+                    "tag",
+                    "remove",
+                    name,
+                    *(index for pair in removed for index in pair),
+                )
+            if len(added := new - old) > 0:
+                self.content.tag_add(name, *(index for pair in added for index in pair))
+
+
+@dataclass
+class ClosedTab:
+    path: Optional[str]
+    cursor: str
+    yview: float
+    # Still alive but hidden, or None once only the above is left
+    document: Optional[Document]
+    # Approximate bytes held by the document
+    size: int
+
+
+class ClosedTabCache:
+    """Recently closed tabs, least recently closed first.
+
+    The `kept` most recent ones stay alive as long as their text fits in
+    `memory` bytes. Older ones are passed to `on_evict` and only their path
+    and view are kept, for at most `CLOSED_TABS` tabs. Documents shown again
+    since they were closed are skipped, and never evicted."""
+
+    def __init__(
+        self, on_evict: Callable[[Document], None], kept: int, memory: int
+    ) -> None:
+        self.on_evict = on_evict
+        self.kept = kept
+        self.memory = memory
+        self.entries: "OrderedDict[str, ClosedTab]" = OrderedDict()
+
+    @staticmethod
+    def _key(document: Document) -> str:
+        return str(document) if document.path is None else _path_key(document.path)
+
+    def push(self, document: Document):
+        key = self._key(document)
+        if (previous := self.entries.pop(key, None)) is not None:
+            if previous.document is not None and previous.document is not document:
+                self.on_evict(previous.document)
+        self.entries[key] = ClosedTab(
+            document.path,
+            *document.view(),
+            document=document,
+            size=len(document.content.buffer) if document.materialized else 0,
+        )
+        self.shrink()
+
+    def pop(self) -> Optional[ClosedTab]:
+        while len(self.entries) > 0:
+            entry = self.entries.popitem()[1]
+            if entry.document is None or entry.document.hidden:
+                return entry
+        return None
+
+    def discard(self, document: Document):
+        key = self._key(document)
+        if (entry := self.entries.get(key)) is not None and entry.document is document:
+            del self.entries[key]
+
+    def shrink(self):
+        for key, entry in list(self.entries.items()):
+            if entry.document is not None and not entry.document.hidden:
+                del self.entries[key]
+        live = [entry for entry in self.entries.values() if entry.document is not None]
+        count = len(live)
+        memory = sum(entry.size for entry in live)
+        for entry in live:
+            if count <= self.kept and memory <= self.memory:
+                break
+            count -= 1
+            memory -= entry.size
+            self._downgrade(entry)
+        while len(self.entries) > CLOSED_TABS:
+            self._downgrade(self.entries.popitem(last=False)[1])
+
+    def _downgrade(self, entry: ClosedTab):
+        if entry.document is None:
+            return
+        document, entry.document, entry.size = entry.document, None, 0
+        if entry.path is None:
+            # Nothing to reopen it from
+            self.entries.pop(str(document), None)
+        self.on_evict(document)
 
 
 class Editor(Notebook):
@@ -289,19 +792,52 @@ class Editor(Notebook):
         *args,
         settings: Settings,
         theme: Dict[object, str],
-        lsp: ThreadedLsp,
+        lsp: LspManager,
         highlighter: PygmentsHighlighter,
         **kwargs,
     ):
         super().__init__(*args, **kwargs)
 
         self.settings = settings
-        self.theme = theme
+        self.styles = StyleRegistry(
+            theme, settings.editor_font_family, settings.editor_font_size
+        )
         self.lsp = lsp
         self.highlighter = highlighter
 
+        # Messages are handled as soon as they arrive where Tk can watch files,
+        # background threads write to a pipe to be noticed too
+        self.wakeup: Optional[SelfPipe] = None
+        if hasattr(self.tk, "createfilehandler"):
+            self.wakeup = SelfPipe()
+            self.tk.createfilehandler(self.wakeup, READABLE, self.pump_messages)
+            for connection in self.highlighter.connections:
+                self.tk.createfilehandler(connection, READABLE, self.pump_messages)
+            self.lsp.on_message = self.wakeup.notify
+        self._pump_timer: Optional[str] = None
+        self.saver = FileSaver(
+            on_result=self.wakeup.notify if self.wakeup is not None else None
+        )
+
+        # Documents of every tab, hidden ones included
+        self.documents_by_name: Dict[str, Document] = {}
+        self.documents_by_path: Dict[str, Document] = {}
+
         self.untitled_file_counter = 1
 
+        self.closed_tabs = ClosedTabCache(
+            self._discard_document,
+            kept=settings.files_closed_tabs_kept,
+            memory=settings.files_closed_tabs_memory,
+        )
+
+        # Lazy tabs next to the selected one, loaded one per idle cycle
+        self._prefetch_queue: Deque[Document] = deque()
+        self._prefetch_timer: Optional[str] = None
+        self.bind("<<NotebookTabChanged>>", self._on_tab_changed)
+
+        self._idle_timer = self.after(LSP_IDLE_CHECK, self._shutdown_idle_servers)
+
         # self.bind("<ButtonPress-2>", self._on_close_press, True)
         # self.bind("<ButtonRelease-2>", self._on_close_release)
 
@@ -309,29 +845,111 @@ class Editor(Notebook):
         #     if self.identify(event.x, event.y) == "label":
         #         print(event)
 
-        self.poll_lsp_messages()
+        # Messages that arrived before the handlers were set up
+        self.pump_messages()
+
+    @property
+    def theme(self) -> Dict[object, str]:
+        return self.styles.theme  # type: ignore
 
     def update_theme(self, theme: Dict[object, str]):
-        self.theme = theme
-        for t in self.tabs():
-            self.nametowidget(t).update_theme(theme)
+        if self.styles.set_theme(theme):  # type: ignore
+            for t in self.tabs():
+                self.nametowidget(t).apply_styles()
 
     def hide(self, tab_id) -> None:
         self.nametowidget(tab_id).hidden = True
+        self.nametowidget(tab_id).close_in_lsp()
         return super().hide(tab_id)
 
+    def forget(self, tab_id) -> None:
+        document = self.nametowidget(tab_id)
+        self.highlighter.forget(document.file_id)
+        self.documents_by_name.pop(str(document), None)
+        if document.path is not None:
+            self._unindex_path(document, document.path)
+        return super().forget(tab_id)
+
     def add(self, child, **kw) -> None:
+        # Shown again, it can't be reopened or evicted anymore
+        self.closed_tabs.discard(child)
         child.hidden = False
+        self.documents_by_name[str(child)] = child
+        if child.path is not None:
+            self.documents_by_path[_path_key(child.path)] = child
         return super().add(child, **kw)
 
-    def focus_file(self, name: str):
-        for t in self.tabs():
-            if self.tab(t, "text") == name:
-                self.select(t)
-                self.nametowidget(t).content.focus_set()
-                return
+    def _on_document_renamed(self, document: Document, previous: Optional[str]):
+        if str(document) not in self.documents_by_name:
+            return
+        if previous is not None:
+            self._unindex_path(document, previous)
+        if document.path is not None:
+            self.documents_by_path[_path_key(document.path)] = document
+
+    def _unindex_path(self, document: Document, path: str):
+        """Stop looking `document` up by `path`, handing the entry to another
+        open tab of the same file if there is one."""
+        key = _path_key(path)
+        if self.documents_by_path.get(key) is not document:
+            return
+        del self.documents_by_path[key]
+        for other in self.documents_by_name.values():
+            if other is not document and other.path is not None:
+                if _path_key(other.path) == key:
+                    self.documents_by_path[key] = other
+                    return
+
+    def focus_document(self, document: Document):
+        if document.hidden:
+            self.add(document)
+            if document.materialized:
+                document.open_in_lsp()
+        document.materialize()
+        self.select(document)
+        document.content.focus_set()
+
+    def _on_tab_changed(self, *_):
+        if self.select() == "":
+            return
+        document = self.nametowidget(self.select())
+        document.materialize()
+
+        index = self.index(document)
+        tabs = self.tabs()
+        self._prefetch_queue.clear()
+        for distance in range(1, self.settings.files_prefetch_tabs + 1):
+            for i in (index + distance, index - distance):
+                if 0 <= i < len(tabs):
+                    neighbour = self.nametowidget(tabs[i])
+                    if not neighbour.materialized and not neighbour.hidden:
+                        self._prefetch_queue.append(neighbour)
+        if len(self._prefetch_queue) > 0 and self._prefetch_timer is None:
+            self._prefetch_timer = self.after_idle(self._prefetch)
+
+    def _shutdown_idle_servers(self):
+        self.lsp.shutdown_idle()
+        self._idle_timer = self.after(LSP_IDLE_CHECK, self._shutdown_idle_servers)
+
+    def _prefetch(self):
+        self._prefetch_timer = None
+        if len(self._prefetch_queue) == 0:
+            return
+        document = self._prefetch_queue.popleft()
+        if str(document) in self.documents_by_name:
+            document.materialize()
+        if len(self._prefetch_queue) > 0:
+            self._prefetch_timer = self.after(1, self._prefetch)
+
+    def new_tab(
+        self,
+        path: Optional[str] = None,
+        on_save: Optional[Callback] = None,
+        lazy: bool = False,
+    ):
+        """Open `path` in a new tab, or a new file when it is None.
 
-    def new_tab(self, path: Optional[str] = None, on_save: Optional[Callback] = None):
+        Lazy tabs only show their title until they are first selected."""
         tab_name_var = StringVar()
 
         if path is None:
@@ -345,26 +963,31 @@ class Editor(Notebook):
             if not os.path.isfile(path):
                 # print(f"{path} is not a file")
                 return
-            for i in self.tabs():
-                current_tab = self.tab(i, option="text")
-                if tab_name_var.get().rstrip(" *") == current_tab.rstrip(" *"):
-                    self.focus_file(current_tab)
-                    return
+            if (open_doc := self.get_tab_by_path(path)) is not None:
+                if open_doc.hidden:
+                    self.reopen_tab(open_doc)
+                else:
+                    self.focus_document(open_doc)
+                return
 
         current_doc = Document(
             self,
             path=path,
-            theme=self.theme,
+            styles=self.styles,
             tab_name=tab_name_var,
             on_save=on_save,
+            on_rename=self._on_document_renamed,
             settings=self.settings,
             highlighter=self.highlighter,
+            saver=self.saver,
+            lsp=self.lsp,
+            lazy=lazy,
         )
         self.add(current_doc, text=tab_name_var.get())
-        self.focus_file(tab_name_var.get())
+        if not lazy:
+            self.focus_document(current_doc)
 
         if path is not None:
-            # textDocument/didOpen
             # textDocument/documentSymbol
             # textDocument/semanticTokens/full
             # textDocument/documentLink
@@ -373,23 +996,36 @@ class Editor(Notebook):
 
         tab_name_var.trace(
             "w",
-            lambda *_: self.tab(len(self.tabs()) - 1, text=tab_name_var.get()),
+            lambda *_: self.tab(current_doc, text=tab_name_var.get()),
         )
 
         # tip = Hovertip(root.nametowidget(self.select()), path, 1000)
 
-    def close_tab(self, name: str, permanent: bool = False):
-        for t in self.tabs():
-            if t == name:
-                if (
-                    self.nametowidget(t).content.edit_modified()
-                    and self.nametowidget(t).is_different_from_disk()
-                ):
-                    if self.nametowidget(t).ask_then_save():
-                        self.forget(t) if permanent else self.hide(t)
-                else:
-                    self.forget(t) if permanent else self.hide(t)
-                return self.nametowidget(t)
+    def close_tab(self, name: str, permanent: bool = False) -> Optional[Document]:
+        """Close the tab `name`, keeping it to be reopened unless `permanent`.
+
+        Returns None when the tab wasn't closed."""
+        document = self.documents_by_name.get(str(name))
+        if document is None:
+            return None
+        if (
+            document.materialized
+            and document.content.edit_modified()
+            and document.is_different_from_disk()
+            and not self.ask_then_save(document)
+        ):
+            return None
+        if permanent:
+            self.closed_tabs.discard(document)
+            self._discard_document(document)
+        else:
+            self.hide(document)
+            self.closed_tabs.push(document)
+        return document
+
+    def _discard_document(self, document: Document):
+        self.forget(document)
+        document.destroy()
 
     def close_all(self, permanent: bool = False):
         for t in self.tabs():
@@ -397,18 +1033,76 @@ class Editor(Notebook):
 
     def reopen_tab(self, widget):
         self.add(widget)
-        widget.load(widget.path)
-        self.focus_file(widget.tab_name.get())
+        if widget.materialized:
+            widget.apply_styles()
+            # Unsaved edits are kept, only the saved text is refreshed
+            if widget.path is not None and not widget.content.edit_modified():
+                widget.load(widget.path)
+            else:
+                # Hiding closed it in the language server
+                widget.open_in_lsp()
+        self.focus_document(widget)
+
+    def reopen_closed_tab(self):
+        """Reopen the most recently closed tab, where it was left."""
+        if (closed := self.closed_tabs.pop()) is None:
+            return
+        if closed.document is not None:
+            self.reopen_tab(closed.document)
+            document = closed.document
+        elif closed.path is not None and self.get_tab_by_path(closed.path) is None:
+            self.new_tab(closed.path)
+            if (document := self.get_tab_by_path(closed.path)) is None:
+                return
+        else:
+            return
+        document.restore_view(closed.cursor, closed.yview)
+
+    def _handle_save_result(self, result: SaveResult):
+        if (tab := self.get_tab_by_file_id(result.request.file_id)) is not None:
+            tab.on_saved(result)
+        elif result.error is not None:
+            print(f"Failed to save {result.request.path}: {result.error}")
+
+    def flush_saves(self) -> bool:
+        """Wait for the files being saved to be written, returning whether
+        they all were."""
+        self.saver.flush()
+        success = True
+        while (result := self.saver.get_result()) is not None:
+            self._handle_save_result(result)
+            success = success and result.error is None
+        return success
+
+    def ask_then_save(self, document: Document) -> bool:
+        """Ask whether to save the changes of `document` and wait for them to
+        be written, returning whether it can be closed."""
+        answer = document.ask_to_save()
+        if answer is None:
+            return False
+        if not answer:
+            return True
+        if not document.save():
+            return False
+        self.flush_saves()
+        if document.save_error is not None:
+            showerror(
+                title="Sublime Tkext",
+                message=f"Failed to save {document.path}: {document.save_error}",
+            )
+            return False
+        return True
 
     def ensure_all_saved(self):
         successes = []
         for t in self.tabs():
             if (
-                self.nametowidget(t).content.edit_modified()
+                self.nametowidget(t).materialized
+                and self.nametowidget(t).content.edit_modified()
                 and self.nametowidget(t).is_different_from_disk()
             ):
-                self.focus_file(self.tab(t, "text"))
-                successes.append(self.nametowidget(t).ask_then_save())
+                self.focus_document(self.nametowidget(t))
+                successes.append(self.ask_then_save(self.nametowidget(t)))
         return all(successes)
 
     def get_state(self) -> list[str]:
@@ -426,34 +1120,88 @@ class Editor(Notebook):
                 )
             else:
                 self.nametowidget(self.select()).content.mark_set("insert", f"{row}.0")
-            self.focus_file(self.tab(self.select(), "text"))
+            self.focus_document(self.nametowidget(self.select()))
 
     def update_settings(self, settings: "Settings"):
         print("Updating editor settings")
+        self.settings = settings
+        self.styles.set_font(settings.editor_font_family, settings.editor_font_size)
         for t in self.tabs():
             self.nametowidget(t).update_settings(settings)
+        self.closed_tabs.kept = settings.files_closed_tabs_kept
+        self.closed_tabs.memory = settings.files_closed_tabs_memory
+        self.closed_tabs.shrink()
+        self.lsp.update_settings(settings.lsp_servers, settings.lsp_idle_timeout)
 
     def get_tab_by_path(self, path: str) -> Optional[Document]:
-        for t in self.tabs():
-            if self.nametowidget(t).path == path:
-                return self.nametowidget(t)
-        return None
+        return self.documents_by_path.get(_path_key(path))
 
-    def poll_lsp_messages(self):
-        # TODO: Maybe the editor class should handle this instead? Since get removes from the queue
-        """Update GUI with items from the queue."""
-        # print("Polling LSP messages")
-        rsp = self.lsp.get_response()
-        # TODO: Delegate to a tab, call a tab's method to handle this depending on type of message
-        # if rsp is not None:
-        #     print(rsp)
+    def get_tab_by_file_id(self, file_id: str) -> Optional[Document]:
+        return self.documents_by_name.get(file_id)
 
-        highlight_rsp = self.highlighter.get_response()
+    def pump_messages(self, *_):
+        """Handle the messages of the language server, the highlighter and the
+        saver until none are left or `PUMP_BUDGET` is spent."""
+        if self.wakeup is not None:
+            self.wakeup.drain()
+        deadline = time.perf_counter() + PUMP_BUDGET
+        while time.perf_counter() < deadline:
+            handled = False
 
-        if highlight_rsp is not None:
-            if (
-                meant_for_tab := self.get_tab_by_path(highlight_rsp.file_id)
-            ) is not None:
-                meant_for_tab.update_tags(highlight_rsp.tokens)
+            if (notification := self.lsp.get_notification()) is not None:
+                # TODO: Delegate to a tab, call a tab's method to handle this depending on type of message
+                handled = True
+
+            if self.lsp.run_callback():
+                handled = True
 
-        self.after(40, self.poll_lsp_messages)  # schedule next update
+            if (highlight_rsp := self.highlighter.get_response()) is not None:
+                self._handle_highlight_response(highlight_rsp)
+                handled = True
+
+            if (save_result := self.saver.get_result()) is not None:
+                self._handle_save_result(save_result)
+                handled = True
+
+            if not handled:
+                break
+        else:
+            # Out of time, the rest is handled once Tk caught up with other
+            # events. Highlighter pipes stay readable by themselves.
+            if self.wakeup is not None:
+                self.wakeup.notify()
+
+        if self.wakeup is None:
+            self._pump_timer = self.after(PUMP_INTERVAL, self.pump_messages)
+
+    def _handle_highlight_response(self, highlight_rsp: HighlightResponse):
+        if (
+            meant_for_tab := self.get_tab_by_file_id(highlight_rsp.file_id)
+        ) is not None and meant_for_tab.is_highlight_current(highlight_rsp.version):
+            meant_for_tab.update_tags(
+                highlight_rsp.tokens,
+                self.highlighter.tag_names[highlight_rsp.worker],
+                highlight_rsp.start,
+                highlight_rsp.end,
+            )
+            if highlight_rsp.done:
+                # Ranges of unfinished versions are re-lexed with the next one
+                meant_for_tab.highlighted_version = highlight_rsp.version
+
+    def destroy(self):
+        if self.wakeup is not None:
+            self.lsp.on_message = None
+            self.saver.on_result = None
+            self.tk.deletefilehandler(self.wakeup)
+            for connection in self.highlighter.connections:
+                self.tk.deletefilehandler(connection)
+            self.wakeup.close()
+            self.wakeup = None
+        if self._pump_timer is not None:
+            self.after_cancel(self._pump_timer)
+            self._pump_timer = None
+        if self._prefetch_timer is not None:
+            self.after_cancel(self._prefetch_timer)
+            self._prefetch_timer = None
+        self.after_cancel(self._idle_timer)
+        super().destroy()
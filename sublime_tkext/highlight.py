@@ -1,13 +1,135 @@
+from array import array
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
-from dataclasses import dataclass
-from multiprocessing import Pipe, Process
-from multiprocessing.connection import PipeConnection
+from dataclasses import dataclass, field
+from multiprocessing import Pipe, Process, Queue
+from multiprocessing.connection import Connection, wait
+from struct import Struct
+import os
+from queue import Empty, SimpleQueue
 import re
-from typing import Any, DefaultDict, Dict, List, Literal, Mapping, Optional, Tuple
+from threading import Thread
+import time
+from typing import (
+    Any,
+    Callable,
+    DefaultDict,
+    Dict,
+    Iterator,
+    List,
+    Literal,
+    Mapping,
+    Optional,
+    Tuple,
+    Union,
+)
 
-from pygments import highlight, lex
-from pygments.lexers import guess_lexer, get_lexer_by_name
-from pygments.token import _TokenType
+try:
+    from multiprocessing.shared_memory import SharedMemory
+except ImportError:
+    SharedMemory = None  # type: ignore
+
+from pygments.lexer import Lexer, RegexLexer
+from pygments.lexers import (
+    TextLexer,
+    get_lexer_by_name,
+    get_lexer_for_filename,
+    guess_lexer,
+)
+from pygments.lexers.c_cpp import CFamilyLexer
+from pygments.util import ClassNotFound
+from pygments.token import Error, Keyword, Name, Whitespace, _TokenType
+
+# Size of the blocks compared when looking for the edited region of a document
+DIFF_BLOCK_SIZE = 4096
+# Texts at least this long go through shared memory when it is enabled
+SHARED_TEXT_THRESHOLD = 64 * 1024
+SHARED_TEXT_MIN_SIZE = 256 * 1024
+# Only this many characters are looked at when guessing a lexer from content
+GUESS_PREFIX_LENGTH = 4096
+# Number of lines lexed before the highlighter checks for new requests
+CHUNK_LINES = 2000
+# Seconds without requests after which edited documents are lexed again from
+# the start, to catch what re-lexing only around the edits missed
+CHECK_DELAY = 0.5
+
+
+@dataclass
+class SharedTextHandle:
+    """Where to find the text of a request in shared memory."""
+
+    name: str
+    version: int
+    length: int
+
+
+# Version and byte length of the text in a shared segment, followed by the text
+SHARED_TEXT_HEADER = Struct("QQ")
+# Version written to the header while the text is being overwritten
+SHARED_TEXT_WRITING = 2**64 - 1
+
+
+class SharedText:
+    """Shared memory segment holding the UTF-8 text of one document.
+
+    The segment is reused across edits and replaced by one twice as large
+    when the text outgrows it."""
+
+    def __init__(self) -> None:
+        self.segment: Optional["SharedMemory"] = None
+
+    def write(self, text: str, version: int) -> SharedTextHandle:
+        data = text.encode("utf-8", "surrogatepass")
+        needed = SHARED_TEXT_HEADER.size + len(data)
+        if self.segment is None or self.segment.size < needed:
+            size = max(needed, SHARED_TEXT_MIN_SIZE)
+            if self.segment is not None:
+                size = max(size, 2 * self.segment.size)
+            self.close()
+            self.segment = SharedMemory(create=True, size=size)  # type: ignore
+        buf = self.segment.buf
+        SHARED_TEXT_HEADER.pack_into(buf, 0, SHARED_TEXT_WRITING, 0)
+        buf[SHARED_TEXT_HEADER.size : needed] = data
+        SHARED_TEXT_HEADER.pack_into(buf, 0, version, len(data))
+        return SharedTextHandle(
+            name=self.segment.name, version=version, length=len(data)
+        )
+
+    def close(self):
+        if self.segment is not None:
+            self.segment.close()
+            self.segment.unlink()
+            self.segment = None
+
+
+def _attach_shared_memory(name: str) -> "SharedMemory":
+    try:
+        return SharedMemory(name=name, track=False)  # type: ignore
+    except TypeError:
+        # Before Python 3.13 attaching also registers the segment with the
+        # resource tracker, racing with the UI unregistering it on unlink
+        from multiprocessing import resource_tracker
+
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return SharedMemory(name=name)  # type: ignore
+        finally:
+            resource_tracker.register = register
+
+
+def read_shared_text(
+    segment: "SharedMemory", handle: SharedTextHandle
+) -> Optional[str]:
+    """Text of `handle`, or None if it was overwritten by a newer version."""
+    buf = segment.buf
+    version, length = SHARED_TEXT_HEADER.unpack_from(buf, 0)
+    if version != handle.version:
+        return None
+    data = bytes(buf[SHARED_TEXT_HEADER.size : SHARED_TEXT_HEADER.size + length])
+    if SHARED_TEXT_HEADER.unpack_from(buf, 0)[0] != version:
+        return None
+    return data.decode("utf-8", "surrogatepass")
 
 
 @dataclass
@@ -15,87 +137,1105 @@ class HighlightRequest:
     file_id: Any
     text: str
     language: Optional[str] = None
+    incremental: bool = True
+    path: Optional[str] = None
+    version: int = 0
+    # Latest version whose response was applied by the UI
+    applied_version: int = -1
+    # First and last visible line, highlighted first
+    viewport: Optional[Tuple[int, int]] = None
+    # Worker the document is pinned to
+    worker: int = 0
+    # Set instead of `text` when the text was written to shared memory
+    shared: Optional[SharedTextHandle] = None
 
 
 @dataclass
-class TagInfo:
-    start: int
-    end: int
-    tag: str
+class ViewportUpdate:
+    file_id: Any
+    viewport: Tuple[int, int]
+
+
+@dataclass
+class Forget:
+    """Drop the state of a closed document."""
+
+    file_id: Any
+
+
+class Tokens:
+    """Parallel arrays of token starts, lengths and tag ids, which pickle to a
+    few flat buffers instead of one object per token."""
+
+    def __init__(self) -> None:
+        self.starts = array("I")
+        self.lengths = array("I")
+        self.tag_ids = array("H")
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def truncate(self, length: int) -> None:
+        del self.starts[length:]
+        del self.lengths[length:]
+        del self.tag_ids[length:]
+
+
+class TagTable:
+    """Interns token types to small ids. Each name is sent to the UI once,
+    with the first response that uses it."""
+
+    def __init__(self) -> None:
+        self.ids: Dict[_TokenType, int] = {}
+        self.names: List[str] = []
+        self.sent = 0
+
+    def intern(self, token_type: _TokenType) -> int:
+        tag_id = self.ids.get(token_type)
+        if tag_id is None:
+            tag_id = self.ids[token_type] = len(self.names)
+            self.names.append(str(token_type))
+        return tag_id
+
+    def take_new_names(self) -> List[str]:
+        new_names = self.names[self.sent :]
+        self.sent = len(self.names)
+        return new_names
 
 
 @dataclass
 class HighlightResponse:
+    """Tokens for the `start`-`end` character range of the requested text.
+
+    Tags outside of this range are still valid and should be left alone.
+    """
+
     file_id: Any
-    tokens: List[TagInfo]
+    tokens: Tokens
     language: str
+    start: int = 0
+    end: int = 0
+    version: int = 0
+    # Names of the tag ids used for the first time, in id order
+    new_tag_names: List[str] = field(default_factory=list)
+    # Worker that lexed the response, tag ids are only valid for that worker
+    worker: int = 0
+    # Number of direct and bulk requests finished by this response
+    handled: int = 0
+    handled_bulk: int = 0
+    # Last response of `version`, which is only fully applied once this is
+    done: bool = False
+
+
+def _common_prefix_length(a: str, b: str) -> int:
+    limit = min(len(a), len(b))
+    i = 0
+    while i < limit and a[i : i + DIFF_BLOCK_SIZE] == b[i : i + DIFF_BLOCK_SIZE]:
+        i += DIFF_BLOCK_SIZE
+    lo, hi = i, min(i + DIFF_BLOCK_SIZE, limit)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[i:mid] == b[i:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _common_suffix_length(a: str, b: str, limit: int) -> int:
+    la, lb = len(a), len(b)
+    i = 0
+    while (
+        i < limit
+        and a[la - min(i + DIFF_BLOCK_SIZE, limit) : la - i]
+        == b[lb - min(i + DIFF_BLOCK_SIZE, limit) : lb - i]
+    ):
+        i = min(i + DIFF_BLOCK_SIZE, limit)
+    lo, hi = i, min(i + DIFF_BLOCK_SIZE, limit)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[la - mid : la - i] == b[lb - mid : lb - i]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+Checkpoint = Tuple[int, None, Tuple[str, ...]]
+Token = Tuple[int, _TokenType, str]
 
 
-def highlight_process(inner_pipe: PipeConnection):
+def _lex_from(
+    lexer: RegexLexer, text: str, pos: int, stack: Tuple[str, ...]
+) -> Iterator[Union[Token, Checkpoint]]:
+    """Same state machine as `RegexLexer.get_tokens_unprocessed`, but able to
+    start in the middle of `text` and yielding `(pos, None, stack)` checkpoints
+    every time a match ends at the start of a line."""
+    tokendefs = lexer._tokens
+    statestack = list(stack)
+    statetokens = tokendefs[statestack[-1]]
     while True:
-        req = inner_pipe.recv()
-        if isinstance(req, HighlightRequest):
-            if req.language is None:
-                lexer = guess_lexer(req.text)
+        for rexmatch, action, new_state in statetokens:
+            m = rexmatch(text, pos)
+            if m:
+                if action is not None:
+                    if type(action) is _TokenType:
+                        yield pos, action, m.group()
+                    else:
+                        # Some callbacks, like the code blocks of Markdown,
+                        # yield the tokens of another lexer with offsets from
+                        # the start of the group it lexed. Those are moved
+                        # after the tokens before them.
+                        expected = shift = 0
+                        for token in action(lexer, m):
+                            if token[0] < expected:
+                                if token[0] + shift != expected:
+                                    shift = expected - token[0]
+                                token = (token[0] + shift, token[1], token[2])
+                            yield token
+                            expected = token[0] + len(token[2])
+                pos = m.end()
+                if new_state is not None:
+                    if isinstance(new_state, tuple):
+                        for state in new_state:
+                            if state == "#pop":
+                                if len(statestack) > 1:
+                                    statestack.pop()
+                            elif state == "#push":
+                                statestack.append(statestack[-1])
+                            else:
+                                statestack.append(state)
+                    elif isinstance(new_state, int):
+                        if abs(new_state) >= len(statestack):
+                            del statestack[1:]
+                        else:
+                            del statestack[new_state:]
+                    elif new_state == "#push":
+                        statestack.append(statestack[-1])
+                    statetokens = tokendefs[statestack[-1]]
+                if pos > 0 and text[pos - 1] == "\n":
+                    yield pos, None, tuple(statestack)
+                break
+        else:
+            if pos >= len(text):
+                return
+            if text[pos] == "\n":
+                statestack = ["root"]
+                statetokens = tokendefs["root"]
+                yield pos, Whitespace, "\n"
+                pos += 1
+                yield pos, None, ("root",)
+                continue
+            yield pos, Error, text[pos]
+            pos += 1
+
+
+def _c_family_token_type(
+    lexer: CFamilyLexer, token_type: _TokenType, value: str
+) -> _TokenType:
+    if token_type is Name and (
+        (lexer.stdlibhighlighting and value in lexer.stdlib_types)
+        or (lexer.c99highlighting and value in lexer.c99_types)
+        or (lexer.c11highlighting and value in lexer.c11_atomic_types)
+        or (lexer.platformhighlighting and value in lexer.linux_types)
+    ):
+        return Keyword.Type
+    return token_type
+
+
+# Overrides of `RegexLexer.get_tokens_unprocessed` that only change the type of
+# some tokens, and the type they change every token to
+_TOKEN_TYPE_REMAPS: Dict[Any, Callable[[Any, _TokenType, str], _TokenType]] = {
+    CFamilyLexer.get_tokens_unprocessed: _c_family_token_type,
+}
+
+
+def _remap_token_types(
+    lexer: Lexer, lexed: Iterator[Union[Token, Checkpoint]]
+) -> Iterator[Union[Token, Checkpoint]]:
+    """Tokens of `_lex_from` as the lexer's own `get_tokens_unprocessed`
+    would have typed them."""
+    remap = _TOKEN_TYPE_REMAPS.get(type(lexer).get_tokens_unprocessed)
+    if remap is None:
+        return lexed
+    return (
+        (pos, token_type, value)
+        if token_type is None
+        else (pos, remap(lexer, token_type, value), value)  # type: ignore
+        for pos, token_type, value in lexed
+    )
+
+
+def _tokens_hash(tokens: Tokens, first: int) -> int:
+    """Hash of the tokens from the `first` one on, wherever they start."""
+    return hash((tokens.lengths[first:].tobytes(), tokens.tag_ids[first:].tobytes()))
+
+
+def _supports_checkpoints(lexer: Lexer) -> bool:
+    if not isinstance(lexer, RegexLexer):
+        return False
+    method = type(lexer).get_tokens_unprocessed
+    return method is RegexLexer.get_tokens_unprocessed or method in _TOKEN_TYPE_REMAPS
+
+
+Chunk = Tuple[int, int, Tokens]
+# A chunk and whether it is the last one of its job
+JobChunk = Tuple[int, int, Tokens, bool]
+
+
+class IncrementalLexer:
+    """Lexer state for one document, kept in the highlighter process.
+
+    The state stack is checkpointed at every line start so that an edit only
+    needs to be re-lexed from the last root state before it until the lexer
+    state matches the previous run again. Re-lexing happens in chunks of
+    `CHUNK_LINES` lines (see `step`) so that other documents and the viewport
+    can be served in between.
+
+    Rules that failed to match before the edited region can match once it
+    changes, like a Go raw string that a later edit closes, so edited
+    documents are checked against a lex from the start (see `check`).
+    """
+
+    def __init__(self, lexer: Lexer, tag_table: TagTable) -> None:
+        self.lexer = lexer
+        self.tag_table = tag_table
+        self.text = ""
+        self.version = 0
+        self.checkpoint_offsets: List[int] = []
+        self.checkpoint_stacks: List[Tuple[str, ...]] = []
+        # Hash of the tokens since the previous checkpoint at every checkpoint,
+        # and of those after the last one
+        self.checkpoint_hashes: List[int] = []
+        self.tail_hash = 0
+        self.lexed = False
+        # Whether the text changed since it was last lexed from the start
+        self.needs_check = False
+        # (version, start, end) of the ranges sent but not acknowledged yet
+        self.unapplied: List[Tuple[int, int, int]] = []
+        # First and last visible line, as reported by the UI
+        self.viewport: Optional[Tuple[int, int]] = None
+        self.language = ""
+
+        # Requests received since the last finished job
+        self.requests = 0
+        self.bulk_requests = 0
+        # Whether the document is pinned to the worker that holds this state
+        self.pinned = True
+
+        self._job: Optional[Iterator[JobChunk]] = None
+        self._frontier = 0
+        self._job_dirty_end = -1
+        # Checkpoint offsets, stacks and hashes of the previous run, and how far
+        # the edit moved them
+        self._job_old: Tuple[List[int], List[Tuple[str, ...]], List[int], int]
+        self._job_old = ([], [], [], 0)
+        self._checking = False
+        # Range left unfinished by an interrupted job
+        self._stale: Optional[Tuple[int, int]] = None
+        self._line_starts: Optional[List[int]] = None
+
+    @property
+    def busy(self) -> bool:
+        return self._job is not None
+
+    def _add_token(
+        self, tokens: Tokens, pos: int, token_type: _TokenType, value: str
+    ) -> None:
+        if value != "":
+            tokens.starts.append(pos)
+            tokens.lengths.append(len(value))
+            tokens.tag_ids.append(self.tag_table.intern(token_type))
+
+    def _full_lex(self, text: str) -> Iterator[JobChunk]:
+        self.checkpoint_offsets = []
+        self.checkpoint_stacks = []
+        self.checkpoint_hashes = []
+        if _supports_checkpoints(self.lexer):
+            return self._lex_until_converged(text, 0, ("root",), -1, [], [], [], 0)
+        self._frontier = 0
+        self._job_dirty_end = len(text)
+        self._job_old = ([], [], [], 0)
+        return self._lex_all_chunks(text)
+
+    def _lex_all_chunks(self, text: str) -> Iterator[JobChunk]:
+        """Lex all of `text` in chunks of `CHUNK_LINES` lines, for lexers
+        that can't be checkpointed."""
+        tags = Tokens()
+        lines = 0
+        for pos, token_type, value in self.lexer.get_tokens_unprocessed(text):
+            self._add_token(tags, pos, token_type, value)
+            lines += value.count("\n")
+            if lines >= CHUNK_LINES:
+                chunk_start, self._frontier = self._frontier, pos + len(value)
+                yield chunk_start, self._frontier, tags, False
+                tags = Tokens()
+                lines = 0
+        yield self._frontier, len(text), tags, True
+
+    def _lex_until_converged(
+        self,
+        text: str,
+        start: int,
+        stack: Tuple[str, ...],
+        dirty_end: int,
+        old_offsets: List[int],
+        old_stacks: List[Tuple[str, ...]],
+        old_hashes: List[int],
+        delta: int,
+    ) -> Iterator[JobChunk]:
+        """Lex `text` from `start` until a line start after `dirty_end` has
+        the same state as one of the (shifted by `delta`) old checkpoints."""
+        self._frontier = start
+        self._job_dirty_end = dirty_end
+        self._job_old = (old_offsets, old_stacks, old_hashes, delta)
+        return self._lex_chunks(text, stack)
+
+    def _lex_chunks(self, text: str, stack: Tuple[str, ...]) -> Iterator[JobChunk]:
+        old_offsets, old_stacks, old_hashes, delta = self._job_old
+        tags = Tokens()
+        offsets = self.checkpoint_offsets
+        stacks = self.checkpoint_stacks
+        hashes = self.checkpoint_hashes
+        # First token after the last checkpoint
+        first = 0
+        j = 0
+        lines = 0
+        lexed = _remap_token_types(
+            self.lexer, _lex_from(self.lexer, text, self._frontier, stack)
+        )
+        for pos, token_type, value in lexed:  # type: ignore
+            if token_type is not None:
+                self._add_token(tags, pos, token_type, value)
+                continue
+            if offsets and offsets[-1] == pos:
+                continue
+            segment_hash = _tokens_hash(tags, first)
+            first = len(tags)
+            # Provisionally lexed lines move the end of the job (see lex_viewport)
+            if pos > self._job_dirty_end:
+                while j < len(old_offsets) and old_offsets[j] + delta < pos:
+                    j += 1
+                if (
+                    j < len(old_offsets)
+                    and old_offsets[j] + delta == pos
+                    and old_stacks[j] == value
+                ):
+                    offsets.extend(o + delta for o in old_offsets[j:])
+                    stacks.extend(old_stacks[j:])
+                    hashes.append(segment_hash)
+                    hashes.extend(old_hashes[j + 1 :])
+                    yield self._frontier, pos, tags, True
+                    return
+            offsets.append(pos)
+            stacks.append(value)  # type: ignore
+            hashes.append(segment_hash)
+            lines += 1
+            if lines == CHUNK_LINES:
+                chunk_start, self._frontier = self._frontier, pos
+                yield chunk_start, pos, tags, False
+                tags = Tokens()
+                first = 0
+                lines = 0
+        self.tail_hash = _tokens_hash(tags, first)
+        yield self._frontier, len(text), tags, True
+
+    def check(self) -> None:
+        """Start lexing the whole text again from the start when it changed
+        since the last time. Only the ranges between checkpoints whose tokens
+        differ from the ones produced before are produced by `step`."""
+        if self.busy or not self.needs_check:
+            return
+        self.needs_check = False
+        self._checking = True
+        self._frontier = 0
+        self._job_old = (
+            self.checkpoint_offsets,
+            self.checkpoint_stacks,
+            self.checkpoint_hashes,
+            0,
+        )
+        self.checkpoint_offsets = []
+        self.checkpoint_stacks = []
+        self.checkpoint_hashes = []
+        self._job = self._check_chunks(self.text)
+
+    def _check_chunks(self, text: str) -> Iterator[JobChunk]:
+        old_offsets, _, old_hashes, _ = self._job_old
+        tags = Tokens()
+        offsets = self.checkpoint_offsets
+        stacks = self.checkpoint_stacks
+        hashes = self.checkpoint_hashes
+        # Start of the changed tokens in `tags`, which are not produced yet
+        changed: Optional[int] = None
+        segment_start = first = 0
+        j = 0
+        lines = 0
+        lexed = _remap_token_types(
+            self.lexer, _lex_from(self.lexer, text, 0, ("root",))
+        )
+        for pos, token_type, value in lexed:  # type: ignore
+            if token_type is not None:
+                self._add_token(tags, pos, token_type, value)
+                continue
+            if offsets and offsets[-1] == pos:
+                continue
+            segment_hash = _tokens_hash(tags, first)
+            j = bisect_left(old_offsets, pos, j)
+            unchanged = (
+                j < len(old_offsets)
+                and old_offsets[j] == pos
+                and old_hashes[j] == segment_hash
+                and (old_offsets[j - 1] if j > 0 else 0) == segment_start
+            )
+            offsets.append(pos)
+            stacks.append(value)  # type: ignore
+            hashes.append(segment_hash)
+            lines += 1
+            if unchanged:
+                tags.truncate(first)
+            elif changed is None:
+                changed = segment_start
+            if (unchanged and changed is not None) or lines == CHUNK_LINES:
+                self._frontier = pos
+                if changed is None:
+                    yield pos, pos, Tokens(), False
+                else:
+                    yield changed, segment_start if unchanged else pos, tags, False
+                    tags = Tokens()
+                    changed = None
+                lines = 0
+            segment_start, first = pos, len(tags)
+
+        tail_hash = _tokens_hash(tags, first)
+        end = len(text)
+        if tail_hash == self.tail_hash and segment_start == (
+            old_offsets[-1] if old_offsets else 0
+        ):
+            tags.truncate(first)
+            end = segment_start
+        elif changed is None:
+            changed = segment_start
+        self.tail_hash = tail_hash
+        if changed is None:
+            yield end, end, Tokens(), True
+        else:
+            yield changed, end, tags, True
+
+    def _abandon_job(self) -> None:
+        """Keep what an unfinished job has lexed so far and remember the rest
+        of its range as stale."""
+        if self._job is None:
+            return
+        old_offsets, old_stacks, old_hashes, delta = self._job_old
+        k = bisect_right(old_offsets, self._frontier - delta)
+        self.checkpoint_offsets.extend(o + delta for o in old_offsets[k:])
+        self.checkpoint_stacks.extend(old_stacks[k:])
+        self.checkpoint_hashes.extend(old_hashes[k:])
+        if self._checking:
+            # Nothing is stale, the check starts over instead
+            self.needs_check = True
+        else:
+            self._stale = (self._frontier, max(self._frontier, self._job_dirty_end))
+        self._job = None
+
+    def update(self, text: str, version: int = 0, applied_version: int = -1) -> None:
+        """Start re-lexing `text`, reusing as much of the previous run as
+        possible. The changed tokens are produced by `step`.
+
+        Ranges sent for versions newer than `applied_version` may have been
+        dropped by the UI, so they are re-lexed as well."""
+        self._abandon_job()
+        self._checking = False
+        self._line_starts = None
+        self.version = version
+        self._job = self._update(text, applied_version)
+
+    def _update(self, text: str, applied_version: int) -> Optional[Iterator[JobChunk]]:
+        old_text = self.text
+        self.text = text
+        if not self.lexed or not _supports_checkpoints(self.lexer):
+            self.lexed = True
+            self.unapplied = []
+            return self._full_lex(text)
+
+        prefix = _common_prefix_length(old_text, text)
+        suffix = _common_suffix_length(
+            old_text, text, min(len(old_text), len(text)) - prefix
+        )
+        old_dirty_end = len(old_text) - suffix
+        new_dirty_end = len(text) - suffix
+        delta = len(text) - len(old_text)
+        if old_text != text:
+            dirty_start, dirty_end = prefix, new_dirty_end
+        else:
+            dirty_start, dirty_end = len(text), -1
+            old_dirty_end = new_dirty_end = 0
+
+        def shift(offset: int) -> int:
+            return offset if offset <= prefix else max(offset + delta, new_dirty_end)
+
+        unapplied = []
+        for version, start, end in self.unapplied:
+            if version <= applied_version:
+                continue
+            unapplied.append((version, shift(start), shift(end)))
+            dirty_start = min(dirty_start, shift(start))
+            dirty_end = max(dirty_end, shift(end))
+        self.unapplied = unapplied
+
+        if self._stale is not None:
+            dirty_start = min(dirty_start, shift(self._stale[0]))
+            dirty_end = max(dirty_end, shift(self._stale[1]))
+            self._stale = None
+        if dirty_end < 0:
+            return None
+
+        i = self._restart_index(text, dirty_start)
+        if i == 0:
+            start, stack = 0, ("root",)
+        else:
+            start, stack = (
+                self.checkpoint_offsets[i - 1],
+                self.checkpoint_stacks[i - 1],
+            )
+        j = bisect_right(self.checkpoint_offsets, old_dirty_end)
+        old_offsets = self.checkpoint_offsets[j:]
+        old_stacks = self.checkpoint_stacks[j:]
+        old_hashes = self.checkpoint_hashes[j:]
+        del self.checkpoint_offsets[i:]
+        del self.checkpoint_stacks[i:]
+        del self.checkpoint_hashes[i:]
+        self.needs_check = True
+        return self._lex_until_converged(
+            text, start, stack, dirty_end, old_offsets, old_stacks, old_hashes, delta
+        )
+
+    def _restart_index(self, text: str, dirty_start: int) -> int:
+        """Number of checkpoints kept when re-lexing from `dirty_start`.
+
+        Rules can look past the end of their match, like Python's docstring
+        rule which only matches once a later line closes the string, so the
+        lexer restarts in the root state, and before the blank lines leading
+        to the edit, which a leading `\\s*` can swallow."""
+        i = text.rfind("\n", 0, dirty_start) - 1
+        while i >= 0 and text[i].isspace():
+            i -= 1
+        restart = 0 if i < 0 else text.find("\n", i) + 1
+        k = bisect_left(self.checkpoint_offsets, restart)
+        while k > 0 and self.checkpoint_stacks[k - 1] != ("root",):
+            k -= 1
+        return k
+
+    def step(self) -> Chunk:
+        """Lex the next chunk of the current job.
+
+        Returns the range of `text` whose tokens changed and the new tokens
+        inside of it."""
+        if self._job is None:
+            return 0, 0, Tokens()
+        start, end, tags, done = next(self._job)
+        if done:
+            self._job = None
+        if end > start:
+            self.unapplied.append((self.version, start, end))
+        return start, end, tags
+
+    def _lex_lines(self, start: int, last: int) -> Chunk:
+        """Lex from `start` to the end of the 1-based line `last` on its own."""
+        end = self.text.find("\n", self._line_offset(last)) + 1 or len(self.text)
+        tags = Tokens()
+        lexed = self.lexer.get_tokens_unprocessed(self.text[start:end])
+        for pos, token_type, value in lexed:
+            self._add_token(tags, start + pos, token_type, value)
+        return start, end, tags
+
+    def _line_offset(self, line: int) -> int:
+        """Offset of the start of the 1-based `line` of the current text."""
+        if self._line_starts is None:
+            self._line_starts = [0] + [m.end() for m in re.finditer("\n", self.text)]
+        line = min(max(line, 1), len(self._line_starts))
+        return self._line_starts[line - 1]
+
+    def lex_viewport(self) -> Optional[Chunk]:
+        """Provisionally lex the visible lines if the current job has not
+        reached them yet. Lines past the job are lexed from the start of the
+        first visible line in the root state; the job overwrites them once it
+        gets there."""
+        if self._job is None or self._checking or self.viewport is None:
+            return None
+        first, last = self.viewport
+        end = self._line_offset(last + 1)
+        if end <= self._frontier:
+            return None
+        start = self._line_offset(first)
+        if not _supports_checkpoints(self.lexer):
+            return self._lex_lines(max(start, self._frontier), last)
+        stack: Tuple[str, ...] = ("root",)
+        if start <= self._frontier:
+            start = self._frontier
+            if self.checkpoint_offsets and self.checkpoint_offsets[-1] == start:
+                stack = self.checkpoint_stacks[-1]
+        tags = Tokens()
+        pos = end
+        lexed = _remap_token_types(
+            self.lexer, _lex_from(self.lexer, self.text, start, stack)
+        )
+        for pos, token_type, value in lexed:  # type: ignore
+            if token_type is None:
+                if pos >= end:
+                    break
             else:
-                lexer = get_lexer_by_name(req.language)
-            tokens = lex(req.text, lexer)
-
-            tags: List[TagInfo] = []
-            (match,) = re.findall(r"^\n*", req.text)
-            current_position = 0 + len(match)
-            for token in tokens:
-                if token[1] != "":
-                    tags.append(
-                        TagInfo(
-                            start=current_position,
-                            end=current_position + len(token[1]),
-                            tag=str(token[0]),
-                        )
-                    )
-                current_position += len(token[1])
-            inner_pipe.send(
+                self._add_token(tags, pos, token_type, value)
+        else:
+            pos = len(self.text)
+        self._job_dirty_end = max(self._job_dirty_end, pos)
+        return start, pos, tags
+
+
+def _language_of(lexer: Lexer) -> str:
+    return lexer.aliases[0] if lexer.aliases else lexer.name
+
+
+class LexerResolver:
+    """Picks the lexer of every document, preferring its file name over its
+    content, and keeps it until the document is renamed or its language is
+    changed explicitly."""
+
+    def __init__(self) -> None:
+        # file_id -> ((path, language), lexer, whether the lexer is final)
+        self.cache: Dict[
+            Any, Tuple[Tuple[Optional[str], Optional[str]], Lexer, bool]
+        ] = {}
+
+    def resolve(
+        self, file_id: Any, path: Optional[str], language: Optional[str], text: str
+    ) -> Lexer:
+        key = (path, language)
+        cached = self.cache.get(file_id)
+        if cached is not None and cached[0] == key and cached[2]:
+            return cached[1]
+
+        final = True
+        prefix = text[:GUESS_PREFIX_LENGTH]
+        if language is not None:
+            lexer = get_lexer_by_name(language)
+        else:
+            try:
+                if path is None:
+                    raise ClassNotFound()
+                lexer = get_lexer_for_filename(path, code=prefix)
+            except ClassNotFound:
+                # Guesses made on a short document are redone as it grows
+                final = len(prefix) == GUESS_PREFIX_LENGTH
+                try:
+                    lexer = guess_lexer(prefix)
+                except ClassNotFound:
+                    lexer = TextLexer()
+        if cached is not None and type(cached[1]) is type(lexer):
+            lexer = cached[1]
+        self.cache[file_id] = (key, lexer, final)
+        return lexer
+
+
+class HighlightWorker:
+    """Main loop of a highlighter process.
+
+    Requests arrive on `inner_pipe` for the documents pinned to this worker.
+    When it has nothing else to do, the worker also steals bulk requests (the
+    first highlight of freshly opened documents) from the queue shared by
+    every worker of the pool."""
+
+    def __init__(
+        self,
+        inner_pipe: Connection,
+        bulk_queue: Optional["Queue[HighlightRequest]"] = None,
+        worker: int = 0,
+    ) -> None:
+        self.inner_pipe = inner_pipe
+        self.bulk_queue = bulk_queue
+        self.worker = worker
+        self.documents: Dict[Any, IncrementalLexer] = {}
+        self.lexers = LexerResolver()
+        self.tag_table = TagTable()
+        # Documents with unfinished jobs, the most recently viewed one last
+        self.queue: List[Any] = []
+        # Responses are sent from a thread so that a UI blocked on sending a
+        # request can never deadlock against a worker blocked on a response
+        self.outbox: "SimpleQueue[HighlightResponse]" = SimpleQueue()
+        Thread(target=self._send_responses, daemon=True).start()
+        # Shared memory segment last used by every document
+        self.segments: Dict[Any, "SharedMemory"] = {}
+
+    def _send_responses(self):
+        while True:
+            self.inner_pipe.send(self.outbox.get())
+
+    def _start_request(
+        self, req: HighlightRequest, requests: int, bulk_requests: int
+    ) -> IncrementalLexer:
+        lexer = self.lexers.resolve(req.file_id, req.path, req.language, req.text)
+
+        document = self.documents.get(req.file_id)
+        if not req.incremental or document is None or document.lexer is not lexer:
+            previous = document
+            document = self.documents[req.file_id] = IncrementalLexer(
+                lexer, self.tag_table
+            )
+            if previous is not None:
+                document.requests = previous.requests
+                document.bulk_requests = previous.bulk_requests
+        document.requests += requests
+        document.bulk_requests += bulk_requests
+        document.pinned = req.worker == self.worker
+        document.language = req.language or _language_of(lexer)
+        if req.viewport is not None:
+            document.viewport = req.viewport
+        document.update(req.text, req.version, req.applied_version)
+        return document
+
+    def _send(self, file_id: Any, document: IncrementalLexer, chunk: Chunk):
+        start, end, tags = chunk
+        done = not document.busy
+        if start == end and not done:
+            # Checks go through unchanged lines without anything to send
+            return
+        self.outbox.put(
+            HighlightResponse(
+                file_id=file_id,
+                tokens=tags,
+                language=document.language,
+                start=start,
+                end=end,
+                version=document.version,
+                new_tag_names=self.tag_table.take_new_names(),
+                worker=self.worker,
+                handled=document.requests if done else 0,
+                handled_bulk=document.bulk_requests if done else 0,
+                done=done,
+            )
+        )
+        if done:
+            document.requests = document.bulk_requests = 0
+            if not document.pinned:
+                # Stolen documents keep getting highlighted by their own worker
+                self._forget(file_id)
+
+    def _forget(self, file_id: Any, requests: int = 0, bulk_requests: int = 0):
+        """Drop the state of a document, finishing its unfinished requests
+        and the given ones."""
+        document = self.documents.pop(file_id, None)
+        if document is not None:
+            requests += document.requests
+            bulk_requests += document.bulk_requests
+        if file_id in self.queue:
+            self.queue.remove(file_id)
+        self.lexers.cache.pop(file_id, None)
+        if (segment := self.segments.pop(file_id, None)) is not None:
+            segment.close()
+        if requests > 0 or bulk_requests > 0:
+            self.outbox.put(
                 HighlightResponse(
-                    file_id=req.file_id,
-                    tokens=tags,
-                    language=req.language or repr(dir(lexer)),
+                    file_id=file_id,
+                    tokens=Tokens(),
+                    language="",
+                    worker=self.worker,
+                    handled=requests,
+                    handled_bulk=bulk_requests,
                 )
             )
 
+    def _load_shared_text(self, req: HighlightRequest) -> bool:
+        """Fill in the text of a request sent through shared memory."""
+        if req.shared is None:
+            return True
+        segment = self.segments.get(req.file_id)
+        if segment is None or segment.name != req.shared.name:
+            if segment is not None:
+                segment.close()
+            try:
+                segment = self.segments[req.file_id] = _attach_shared_memory(
+                    req.shared.name
+                )
+            except FileNotFoundError:
+                # Replaced by a larger segment in the meantime
+                self.segments.pop(req.file_id, None)
+                return False
+        text = read_shared_text(segment, req.shared)
+        if text is None:
+            return False
+        req.text = text
+        return True
+
+    def _steal(self, timeout: Optional[float] = None) -> Optional[HighlightRequest]:
+        """Block until a message arrives, a bulk request can be stolen or
+        `timeout` seconds passed, returning the stolen request."""
+        waited: List[Any] = [self.inner_pipe]
+        if self.bulk_queue is not None:
+            # Queue._reader becomes readable when something is put in the queue
+            waited.append(self.bulk_queue._reader)  # type: ignore
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.inner_pipe.poll():
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return None
+            if len(wait(waited, remaining)) == 0:
+                return None
+            if self.bulk_queue is None:
+                continue
+            try:
+                return self.bulk_queue.get_nowait()
+            except Empty:
+                continue
+        return None
+
+    def _unchecked(self) -> Optional[Any]:
+        """A document edited since it was last lexed from the start."""
+        for file_id, document in self.documents.items():
+            if document.needs_check:
+                return file_id
+        return None
+
+    def run(self):
+        while True:
+            # Only the newest version of every document is worth lexing
+            latest: Dict[Any, HighlightRequest] = {}
+            counts: Dict[Any, int] = defaultdict(int)
+            bulk_counts: Dict[Any, int] = defaultdict(int)
+            scrolled: Dict[Any, ViewportUpdate] = {}
+            # Requests of closed documents, dropped without being lexed
+            forgotten: Dict[Any, Tuple[int, int]] = {}
+            if len(self.queue) == 0:
+                unchecked = self._unchecked()
+                stolen = self._steal(None if unchecked is None else CHECK_DELAY)
+                if stolen is not None:
+                    latest[stolen.file_id] = stolen
+                    bulk_counts[stolen.file_id] += 1
+                elif unchecked is not None and not self.inner_pipe.poll():
+                    # Edits paused, the check is interrupted by the next one
+                    self.documents[unchecked].check()
+                    self.queue.append(unchecked)
+            while (
+                len(self.queue) == 0 and len(latest) == 0 and len(forgotten) == 0
+            ) or self.inner_pipe.poll():
+                req = self.inner_pipe.recv()
+                if isinstance(req, HighlightRequest):
+                    counts[req.file_id] += 1
+                    current = latest.get(req.file_id)
+                    if current is None or req.version >= current.version:
+                        if current is not None:
+                            req.applied_version = max(
+                                req.applied_version, current.applied_version
+                            )
+                            req.viewport = req.viewport or current.viewport
+                        latest[req.file_id] = req
+                elif isinstance(req, ViewportUpdate):
+                    scrolled[req.file_id] = req
+                elif isinstance(req, Forget):
+                    latest.pop(req.file_id, None)
+                    scrolled.pop(req.file_id, None)
+                    requests, bulk_requests = forgotten.get(req.file_id, (0, 0))
+                    forgotten[req.file_id] = (
+                        requests + counts.pop(req.file_id, 0),
+                        bulk_requests + bulk_counts.pop(req.file_id, 0),
+                    )
+
+            for file_id, (requests, bulk_requests) in forgotten.items():
+                self._forget(file_id, requests, bulk_requests)
+
+            for file_id, req in latest.items():
+                if not self._load_shared_text(req):
+                    # Overwritten by a newer version whose request is on its way
+                    self.outbox.put(
+                        HighlightResponse(
+                            file_id=file_id,
+                            tokens=Tokens(),
+                            language="",
+                            version=req.version,
+                            worker=self.worker,
+                            handled=counts[file_id],
+                            handled_bulk=bulk_counts[file_id],
+                        )
+                    )
+                    continue
+                document = self._start_request(
+                    req, counts[file_id], bulk_counts[file_id]
+                )
+                if file_id in self.queue:
+                    self.queue.remove(file_id)
+                self._send(file_id, document, document.step())
+                if document.busy:
+                    self.queue.append(file_id)
+                    if (visible := document.lex_viewport()) is not None:
+                        self._send(file_id, document, visible)
+
+            for update in scrolled.values():
+                document = self.documents.get(update.file_id)
+                if document is None:
+                    continue
+                document.viewport = update.viewport
+                if update.file_id in self.queue:
+                    self.queue.remove(update.file_id)
+                    self.queue.append(update.file_id)
+                    if (visible := document.lex_viewport()) is not None:
+                        self._send(update.file_id, document, visible)
+
+            if len(self.queue) > 0 and not self.inner_pipe.poll():
+                file_id = self.queue[-1]
+                document = self.documents[file_id]
+                self._send(file_id, document, document.step())
+                if not document.busy:
+                    self.queue.pop()
+
+
+def highlight_process(
+    inner_pipe: Connection,
+    bulk_queue: Optional["Queue[HighlightRequest]"] = None,
+    worker: int = 0,
+):
+    HighlightWorker(inner_pipe, bulk_queue, worker).run()
+
+
+def _default_worker_count() -> int:
+    try:
+        cores = len(os.sched_getaffinity(0))  # type: ignore
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    # Leave a core to the UI
+    return max(1, cores - 1)
+
 
 class PygmentsHighlighter:
-    def __init__(self) -> None:
-        self.connection, inner_connection = Pipe()
-        self.highlight_process = Process(
-            target=highlight_process,
-            args=(inner_connection,),
-            daemon=True,
+    """Pool of highlighter processes.
+
+    Every document is pinned to one worker so that its incremental lexer
+    state stays in one place. The first highlight of a document is a bulk
+    request, which goes to any idle worker if its own is busy."""
+
+    def __init__(self, workers: Optional[int] = None) -> None:
+        self.bulk_queue: "Queue[HighlightRequest]" = Queue()
+        self.connections: List[Connection] = []
+        self.highlight_processes: List[Process] = []
+        for worker in range(workers or _default_worker_count()):
+            connection, inner_connection = Pipe()
+            self.connections.append(connection)
+            process = Process(
+                target=highlight_process,
+                args=(inner_connection, self.bulk_queue, worker),
+                daemon=True,
+            )
+            process.start()
+            self.highlight_processes.append(process)
+        # Tag name of every tag id of every worker, filled in as responses arrive
+        self.tag_names: List[List[str]] = [[] for _ in self.connections]
+        # Requests sent to every worker that it has not finished yet
+        self.in_flight = [0 for _ in self.connections]
+        self.bulk_in_flight = 0
+        self.assignments: Dict[Any, int] = {}
+        self.shared_texts: Dict[Any, SharedText] = {}
+        self._next_connection = 0
+
+    def _worker_for(self, file_identifier: Any) -> int:
+        worker = self.assignments.get(file_identifier)
+        if worker is None:
+            load = [0 for _ in self.connections]
+            for assigned in self.assignments.values():
+                load[assigned] += 1
+            worker = self.assignments[file_identifier] = min(
+                range(len(load)), key=lambda w: (self.in_flight[w], load[w])
+            )
+        return worker
+
+    def queue_depths(self) -> List[int]:
+        """Number of unfinished requests of every worker."""
+        return list(self.in_flight)
+
+    def forget(self, file_identifier: Any):
+        if (worker := self.assignments.pop(file_identifier, None)) is not None:
+            self.connections[worker].send(Forget(file_id=file_identifier))
+        if (shared_text := self.shared_texts.pop(file_identifier, None)) is not None:
+            shared_text.close()
+
+    def close(self):
+        for shared_text in self.shared_texts.values():
+            shared_text.close()
+        self.shared_texts.clear()
+
+    def send_highlight_request(
+        self,
+        code: str,
+        file_identifier: Any,
+        incremental: bool = True,
+        version: int = 0,
+        applied_version: int = -1,
+        viewport: Optional[Tuple[int, int]] = None,
+        path: Optional[str] = None,
+        language: Optional[str] = None,
+        bulk: bool = False,
+        shared: bool = False,
+    ):
+        handle = None
+        if shared and SharedMemory is not None and len(code) >= SHARED_TEXT_THRESHOLD:
+            # Written once here, the pipe only carries where to find it
+            shared_text = self.shared_texts.setdefault(file_identifier, SharedText())
+            handle = shared_text.write(code, version)
+            code = ""
+        req = HighlightRequest(
+            file_id=file_identifier,
+            text=code,
+            path=path,
+            language=language,
+            incremental=incremental,
+            version=version,
+            applied_version=applied_version,
+            viewport=viewport,
+            worker=(worker := self._worker_for(file_identifier)),
+            shared=handle,
         )
-        self.highlight_process.start()
+        if bulk and self.in_flight[worker] > 0:
+            self.bulk_in_flight += 1
+            self.bulk_queue.put(req)
+        else:
+            self.in_flight[worker] += 1
+            self.connections[worker].send(req)
 
-    def send_highlight_request(self, code: str, file_identifier: Any):
-        self.connection.send(HighlightRequest(file_id=file_identifier, text=code))
+    def send_viewport(self, file_identifier: Any, first_line: int, last_line: int):
+        self.connections[self._worker_for(file_identifier)].send(
+            ViewportUpdate(file_id=file_identifier, viewport=(first_line, last_line))
+        )
 
     def get_response(self) -> Optional[HighlightResponse]:
-        if self.connection.poll():
-            return self.connection.recv()
+        for _ in range(len(self.connections)):
+            connection = self.connections[self._next_connection]
+            self._next_connection = (self._next_connection + 1) % len(self.connections)
+            if connection.poll():
+                rsp: HighlightResponse = connection.recv()
+                self.tag_names[rsp.worker].extend(rsp.new_tag_names)
+                self.in_flight[rsp.worker] -= rsp.handled
+                self.bulk_in_flight -= rsp.handled_bulk
+                return rsp
         return None
 
 
 def parse_styles(d: Mapping[_TokenType, str]) -> Dict[str, Dict]:
     output_dict: Dict[str, Dict] = {}
+    cache: Dict[_TokenType, DefaultDict[str, Any]] = {}
     for k in d:
         if str(k) not in output_dict.keys():
-            output_dict[str(k)] = parse_style_string(k, d)
+            output_dict[str(k)] = parse_style_string(k, d, cache)
     return output_dict
 
 
 def parse_style_string(
-    k: _TokenType, d: Mapping[_TokenType, str]
+    k: _TokenType,
+    d: Mapping[_TokenType, str],
+    cache: Optional[Dict[_TokenType, DefaultDict[str, Any]]] = None,
 ) -> DefaultDict[str, Any]:
+    if cache is not None and k in cache:
+        return cache[k].copy()
     styles = d[k].split(" ")
     style_dict: DefaultDict[str, Any] = (
-        parse_style_string(k.parent, d)
+        parse_style_string(k.parent, d, cache)
         if k.parent is not None
         else defaultdict(lambda: None)
     )
@@ -116,4 +1256,6 @@ def parse_style_string(
             style_dict["bold"] = False
         elif style == "nounderline":
             style_dict["underline"] = False
+    if cache is not None:
+        cache[k] = style_dict.copy()
     return style_dict
@@ -0,0 +1,219 @@
+import asyncio
+from concurrent.futures import Future
+from itertools import count
+import json
+from threading import Lock, Thread
+from typing import Any, Callable, Dict, List, Optional, Union
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = Lock()
+
+
+def event_loop() -> asyncio.AbstractEventLoop:
+    """Event loop of every client, running on its own thread."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            Thread(target=_loop.run_forever, name="jsonrpc", daemon=True).start()
+        return _loop
+
+
+def encode(message: Dict) -> bytes:
+    body = json.dumps(message, ensure_ascii=False, separators=(",", ":")).encode()
+    return b"Content-Length: %d\r\n\r\n" % len(body) + body
+
+
+def content_length(headers: bytes) -> int:
+    for line in headers.split(b"\r\n"):
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"content-length":
+            return int(value)
+    raise ValueError("Missing Content-Length header")
+
+
+class JsonRpcError(Exception):
+    """Error response to a request."""
+
+    def __init__(self, error: Dict) -> None:
+        super().__init__(error.get("message", ""))
+        self.code: int = error.get("code", 0)
+        self.data = error.get("data")
+
+
+class PendingRequest(Future):
+    """Future of the result of a request."""
+
+    def __init__(self, request_id: int, method: str) -> None:
+        super().__init__()
+        self.request_id = request_id
+        self.method = method
+
+
+class JsonRpcClient:
+    """JSON-RPC over the standard streams of a process.
+
+    Reading and writing happen on the event loop thread, so that no method
+    blocks on the process. Messages from the process other than responses are
+    passed to `on_message` on that thread, where the futures of requests are
+    completed too."""
+
+    def __init__(
+        self,
+        cmd: List[str],
+        on_message: Callable[[Dict], None],
+        on_cancel: Optional[Callable[[int], None]] = None,
+    ) -> None:
+        self.on_message = on_message
+        # Called with the id of every request given up on, to tell the process
+        self.on_cancel = on_cancel
+        self.ids = count(1)
+        # Requests sent that weren't answered yet, by id
+        self.pending: Dict[int, PendingRequest] = {}
+        self.lock = Lock()
+        # Messages not written yet, written together
+        self.outgoing: List[bytes] = []
+        self.loop = event_loop()
+        # Waited for, so that a missing command raises here
+        self.process = asyncio.run_coroutine_threadsafe(
+            self._spawn(cmd), self.loop
+        ).result()
+
+    async def _spawn(self, cmd: List[str]) -> asyncio.subprocess.Process:
+        process = await asyncio.create_subprocess_exec(
+            *cmd, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE
+        )
+        self.writable = asyncio.Event()
+        self.loop.create_task(self._read(process.stdout))  # type: ignore
+        self.loop.create_task(self._write(process.stdin))  # type: ignore
+        return process
+
+    async def _read(self, stdout: asyncio.StreamReader):
+        try:
+            while True:
+                headers = await stdout.readuntil(b"\r\n\r\n")
+                body = await stdout.readexactly(content_length(headers))
+                try:
+                    message = json.loads(body)
+                except ValueError as e:
+                    print(f"Dropped an invalid message: {e}")
+                    continue
+                self._dispatch(message)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            # Nothing is coming anymore
+            with self.lock:
+                pending, self.pending = self.pending, {}
+            for future in pending.values():
+                self._finish(future, error=ConnectionError("Process exited"))
+
+    async def _write(self, stdin: asyncio.StreamWriter):
+        while True:
+            await self.writable.wait()
+            self.writable.clear()
+            data, self.outgoing = b"".join(self.outgoing), []
+            try:
+                stdin.write(data)
+                await stdin.drain()
+            except ConnectionError:
+                return
+
+    def _dispatch(self, message: Dict):
+        if "method" in message:
+            self.on_message(message)
+            return
+        with self.lock:
+            future = self.pending.pop(message.get("id"), None)  # type: ignore
+        if future is None:
+            # Cancelled or timed out already
+            return
+        if "error" in message:
+            self._finish(future, error=JsonRpcError(message["error"]))
+        else:
+            self._finish(future, result=message.get("result"))
+
+    def _finish(
+        self,
+        future: PendingRequest,
+        error: Optional[BaseException] = None,
+        result: Any = None,
+    ):
+        if not future.set_running_or_notify_cancel():
+            # Cancelled by whoever sent it
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _queue(self, data: bytes):
+        self.outgoing.append(data)
+        self.writable.set()
+
+    def write(self, message: Dict):
+        self.loop.call_soon_threadsafe(self._queue, encode(message))
+
+    def register(self, method: str, timeout: Optional[float] = None) -> PendingRequest:
+        """Future of the result of a request, which is then written with its
+        `request_id`. It fails with TimeoutError after `timeout` seconds."""
+        future = PendingRequest(next(self.ids), method)
+        with self.lock:
+            self.pending[future.request_id] = future
+        if timeout is not None:
+            self.loop.call_soon_threadsafe(
+                self.loop.call_later, timeout, self._expire, future.request_id
+            )
+        return future
+
+    def request(
+        self,
+        method: str,
+        params: Optional[Union[Dict, List]] = None,
+        timeout: Optional[float] = None,
+    ) -> PendingRequest:
+        future = self.register(method, timeout)
+        self.write(
+            {
+                "jsonrpc": "2.0",
+                "id": future.request_id,
+                "method": method,
+                "params": params,
+            }
+        )
+        return future
+
+    def notify(self, method: str, params: Optional[Union[Dict, List]] = None):
+        self.write({"jsonrpc": "2.0", "method": method, "params": params})
+
+    def _forget(self, request_id: int) -> Optional[PendingRequest]:
+        with self.lock:
+            future = self.pending.pop(request_id, None)
+        if future is not None and self.on_cancel is not None:
+            self.on_cancel(request_id)
+        return future
+
+    def _expire(self, request_id: int):
+        if (future := self._forget(request_id)) is not None:
+            self._finish(future, error=TimeoutError(f"{future.method} timed out"))
+
+    def cancel(self, future: PendingRequest):
+        future.cancel()
+        self._forget(future.request_id)
+
+    def _kill(self):
+        if self.process.returncode is None:
+            self.process.kill()
+
+    async def _wait_then_kill(self, grace: float):
+        try:
+            await asyncio.wait_for(self.process.wait(), grace)
+        except asyncio.TimeoutError:
+            self._kill()
+
+    def close(self, grace: Optional[float] = None):
+        """Kill the process, after `grace` seconds to exit by itself."""
+        if grace is None:
+            self.loop.call_soon_threadsafe(self._kill)
+        else:
+            asyncio.run_coroutine_threadsafe(self._wait_then_kill(grace), self.loop)
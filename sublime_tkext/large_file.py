@@ -0,0 +1,91 @@
+import mmap
+from bisect import bisect_left
+from itertools import accumulate
+from typing import List, Tuple
+
+# Characters read per step when streaming a large file into the editor
+LOAD_CHUNK_SIZE = 1024 * 1024
+# Bytes of a memory-mapped file materialized around the viewport
+WINDOW_SIZE = 1024 * 1024
+# Granularity of the newline index of a memory-mapped file
+BLOCK_SIZE = 1024 * 1024
+
+
+class MappedFile:
+    """Read-only memory map of a file, of which only windows of whole lines
+    are decoded.
+
+    The number of newlines of every block of the file is counted when it is
+    opened, so that the line number of any offset is cheap to find."""
+
+    def __init__(self, path: str) -> None:
+        self.file = open(path, "rb")
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            self.map = None
+        self.size = 0 if self.map is None else len(self.map)
+        # Number of newlines before the start of every block
+        self.block_lines: List[int] = list(
+            accumulate(
+                (
+                    self.map[start : start + BLOCK_SIZE].count(b"\n")  # type: ignore
+                    for start in range(0, self.size, BLOCK_SIZE)
+                ),
+                initial=0,
+            )
+        )
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+    @property
+    def line_count(self) -> int:
+        return self.block_lines[-1] + 1
+
+    def line_of(self, offset: int) -> int:
+        """1-based line of the byte at `offset`."""
+        if self.map is None:
+            return 1
+        block = offset // BLOCK_SIZE
+        start = block * BLOCK_SIZE
+        return (
+            self.block_lines[block]
+            + self.map[start:offset].count(b"\n")  # type: ignore
+            + 1
+        )
+
+    def line_offset(self, line: int) -> int:
+        """Offset of the start of the 1-based `line`."""
+        if line <= 1 or self.map is None:
+            return 0
+        if line > self.line_count:
+            return self.size
+        # Block holding the newline that ends the previous line
+        block = bisect_left(self.block_lines, line - 1) - 1
+        offset = block * BLOCK_SIZE - 1
+        for _ in range(line - 1 - self.block_lines[block]):
+            offset = self.map.find(b"\n", offset + 1)
+        return offset + 1
+
+    def window(self, offset: int, size: int = WINDOW_SIZE) -> Tuple[int, int]:
+        """Start and end of the whole lines around `offset`, about `size`
+        bytes long."""
+        if self.map is None:
+            return 0, 0
+        start = max(0, min(offset - size // 2, self.size - size))
+        if start > 0:
+            start = self.map.rfind(b"\n", 0, start) + 1
+        end = min(self.size, max(start + size, offset + 1))
+        if end < self.size:
+            newline = self.map.find(b"\n", end)
+            end = self.size if newline < 0 else newline + 1
+        return start, end
+
+    def text(self, start: int, end: int) -> str:
+        if self.map is None:
+            return ""
+        return self.map[start:end].decode("utf-8", "replace")
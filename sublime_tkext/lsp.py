@@ -1,10 +1,51 @@
+from concurrent.futures import Future
 import os
-from queue import Empty, Queue
-from subprocess import PIPE, Popen
-from threading import Thread
-from typing import Dict, List, Optional, Union
+from pathlib import Path
+from queue import Empty, SimpleQueue
+from threading import Lock
+import time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
+
+from pygments.lexers import find_lexer_class_for_filename
+
+from .jsonrpc import JsonRpcClient, PendingRequest
+from .piece_table import PieceTable
+
+# TextDocumentSyncKind
+SYNC_NONE = 0
+SYNC_FULL = 1
+SYNC_INCREMENTAL = 2
+
+METHOD_NOT_FOUND = -32601
+
+# Seconds after which requests are given up on by default
+REQUEST_TIMEOUT = 10.0
+# Seconds a server is given to exit once asked to, before it is killed
+SHUTDOWN_TIMEOUT = 2.0
+
+
+def path_to_uri(path: str) -> str:
+    return Path(os.path.abspath(path)).as_uri()
+
+
+def language_id(path: str) -> Optional[str]:
+    """Language identifier of the file at `path`, from its name."""
+    lexer = find_lexer_class_for_filename(path)
+    if lexer is None or len(lexer.aliases) == 0:
+        return None
+    return lexer.aliases[0]
+
+
+def lsp_position(text: PieceTable, offset: int) -> Dict[str, int]:
+    """Position of `offset` in `text`, in the UTF-16 code units the protocol
+    counts characters in."""
+    line, col = text.position(offset)
+    prefix = text.slice(text.line_offset(line), offset)
+    return {
+        "line": line - 1,
+        "character": col + sum(1 for c in prefix if ord(c) > 0xFFFF),
+    }
 
-from pylsp_jsonrpc import streams
 
 # interface TextDocumentItem {
 # 	/**
@@ -31,124 +72,363 @@ from pylsp_jsonrpc import streams
 
 
 class ThreadedLsp:
-    def __init__(self, cmd: List[str], language_target: str = "python") -> None:
-        self.request_id = 0
-
-        self.process = Popen(
-            cmd,
-            stdin=PIPE,
-            stdout=PIPE,
-        )
+    def __init__(
+        self,
+        cmd: List[str],
+        language_target: str,
+        root_uri: Optional[str] = None,
+        on_message: Optional[Callable[[], None]] = None,
+    ) -> None:
+        # Filled on the event loop thread and emptied on the Tk thread
+        self.notifications: "SimpleQueue[Dict]" = SimpleQueue()
+        self.callbacks: "SimpleQueue[Tuple[Callable, Future]]" = SimpleQueue()
+        # Called from the event loop thread after every notification or
+        # callback is queued
+        self.on_message = on_message
+        # Latest request of every method that a new one supersedes
+        self.latest: Dict[str, PendingRequest] = {}
 
-        self.rsp_queue: Queue[Dict] = Queue(maxsize=1024)
-        self.writer = streams.JsonRpcStreamWriter(self.process.stdin)
-        self.reader = streams.JsonRpcStreamReader(self.process.stdout)
+        self.capabilities: Dict[str, Any] = {}
+        # Messages are held back until the server is initialized
+        self.initialized = False
+        self.backlog: List[Tuple[Dict, Optional[PieceTable]]] = []
+        self.lock = Lock()
+        # Version of every open document, by uri
+        self.versions: Dict[str, int] = {}
+        # When the last document was closed, or the server started
+        self.idle_since = time.monotonic()
 
-        self.thread = Thread(target=lambda: self.reader.listen(self.read), daemon=True)
-        self.thread.start()
+        self.language_target = language_target
+        self.root_uri = root_uri
 
-        self.initialization_id = -1
-        self.capabilities = {}
+        self.client = JsonRpcClient(
+            cmd, on_message=self.read, on_cancel=self._send_cancel
+        )
 
-        self.send_initialize_request(root_uri=None)
+        self.send_initialize_request(root_uri=root_uri)
 
-        self.language_target = language_target
+    def read(self, msg: Dict):
+        if "id" in msg:
+            # Requests from the server aren't supported
+            self.client.write(
+                {
+                    "jsonrpc": "2.0",
+                    "id": msg["id"],
+                    "error": {
+                        "code": METHOD_NOT_FOUND,
+                        "message": f"Unsupported method {msg['method']}",
+                    },
+                }
+            )
+        else:
+            self.notifications.put(msg)
+            if self.on_message is not None:
+                self.on_message()
 
-    def _generate_request_id(self) -> int:
-        self.request_id += 1
-        return self.request_id
+    def _send_cancel(self, request_id: int):
+        with self.lock:
+            if self.initialized:
+                self.client.notify("$/cancelRequest", {"id": request_id})
+            else:
+                # Not sent yet, and now never will be
+                self.backlog = [
+                    (message, text)
+                    for message, text in self.backlog
+                    if message.get("id") != request_id
+                ]
 
-    def read(self, msg: Dict):
-        if msg["id"] == self.initialization_id:
-            self.capabilities = msg["result"]["capabilities"]
-        self.rsp_queue.put(msg)
+    def _queue_callback(self, callback: Callable, future: PendingRequest):
+        if future.cancelled():
+            return
+        self.callbacks.put((callback, future))
+        if self.on_message is not None:
+            self.on_message()
 
-    def send(
+    def request(
         self,
         method: str,
         params: Optional[Union[Dict, List]] = None,
-    ):
-        self.writer.write(
+        callback: Optional[Callable[[PendingRequest], None]] = None,
+        timeout: Optional[float] = REQUEST_TIMEOUT,
+        supersede: bool = False,
+    ) -> PendingRequest:
+        """Send a request, whose result or error ends up in the returned
+        future, and is passed to `callback` on the Tk thread.
+
+        A request that `supersede`s cancels the unanswered previous request of
+        the same method, whose callback isn't called. Requests that time out
+        fail with TimeoutError."""
+        future = self.client.register(method, timeout)
+        if supersede:
+            previous = self.latest.get(method)
+            if previous is not None and not previous.done():
+                self.client.cancel(previous)
+            self.latest[method] = future
+        if callback is not None:
+            future.add_done_callback(lambda f: self._queue_callback(callback, f))
+        self._send(
             {
                 "jsonrpc": "2.0",
-                "id": (out := self._generate_request_id()),
+                "id": future.request_id,
                 "method": method,
                 "params": params,
             }
         )
-        return out
+        return future
+
+    def notify(
+        self,
+        method: str,
+        params: Optional[Union[Dict, List]] = None,
+        text: Optional[PieceTable] = None,
+    ):
+        """Send a notification. The changes of a didChange are replaced by
+        `text` if the server can't take ranges."""
+        self._send({"jsonrpc": "2.0", "method": method, "params": params}, text)
+
+    def _send(self, message: Dict, text: Optional[PieceTable] = None):
+        # Only the initialize request may be sent before the server answers it
+        with self.lock:
+            if self.initialized or message["method"] == "initialize":
+                self._write(message, text)
+            else:
+                self.backlog.append((message, text))
+
+    def _write(self, message: Dict, text: Optional[PieceTable]):
+        if message["method"] == "textDocument/didChange":
+            kind = self.sync_kind
+            if kind == SYNC_NONE:
+                return
+            if kind == SYNC_FULL and text is not None:
+                message["params"]["contentChanges"] = [{"text": text.text()}]
+        self.client.write(message)
+
+    def _on_initialized(self, future: "Future[Any]"):
+        if future.exception() is not None:
+            print(f"Failed to initialize the language server: {future.exception()}")
+            return
+        self.capabilities = future.result()["capabilities"]
+        with self.lock:
+            self.initialized = True
+            self.client.notify("initialized", {})
+            for message, text in self.backlog:
+                self._write(message, text)
+            self.backlog.clear()
+
+    @property
+    def sync_kind(self) -> int:
+        sync = self.capabilities.get("textDocumentSync", SYNC_NONE)
+        if isinstance(sync, dict):
+            return sync.get("change", SYNC_NONE)
+        return sync
 
     def exit(self):
-        self.send_exit_request()
-        self.process.kill()
-        self.writer.close()
-        self.reader.close()
+        """Kill the server right away."""
+        self.client.close()
 
-    def get_response(self) -> Optional[Dict]:
+    def shutdown(self):
+        """Ask the server to shut down and exit, killing it if it doesn't."""
+        if not self.initialized:
+            self.exit()
+            return
+        self.request("shutdown", timeout=SHUTDOWN_TIMEOUT).add_done_callback(
+            lambda _: self._send_exit()
+        )
+
+    def _send_exit(self):
+        self.client.notify("exit")
+        self.client.close(grace=SHUTDOWN_TIMEOUT)
+
+    def is_idle(self, timeout: float) -> bool:
+        """Whether no document was open in the server for `timeout` seconds."""
+        return len(self.versions) == 0 and time.monotonic() - self.idle_since > timeout
+
+    def get_notification(self) -> Optional[Dict]:
         try:
-            return self.rsp_queue.get_nowait()
+            return self.notifications.get_nowait()
         except Empty:
             return None
 
+    def run_callback(self) -> bool:
+        """Call the callback of one finished request, if any."""
+        try:
+            callback, future = self.callbacks.get_nowait()
+        except Empty:
+            return False
+        callback(future)
+        return True
+
     def send_initialize_request(self, root_uri: Optional[str]):
-        self.initialization_id = self.send(
+        self.request(
             method="initialize",
             params={
                 "processId": os.getpid(),
                 "rootUri": root_uri,
-                "capabilities": {},
+                "capabilities": {
+                    "textDocument": {
+                        "synchronization": {"didSave": True},
+                        "completion": {
+                            "completionItem": {
+                                "resolveSupport": {
+                                    "properties": ["detail", "documentation"]
+                                },
+                            },
+                        },
+                    },
+                },
             },
-        )
-
-    def send_exit_request(self):
-        pass
+            timeout=None,
+        ).add_done_callback(self._on_initialized)
 
     def send_did_open_noti(self, path: str, text_document: str):
-        self.did_open_id = self.send(
+        uri = path_to_uri(path)
+        self.versions[uri] = 1
+        self.notify(
             method="textDocument/didOpen",
             params={
                 "textDocument": {
-                    "uri": "file://" + path,
-                    "languageId": self.language_target,
+                    "uri": uri,
+                    "languageId": language_id(path) or self.language_target,
                     "version": 1,
                     "text": text_document,
                 }
             },
         )
 
-    def send_did_change_noti(self, path: str, text_document: str):
-        self.did_change_id = self.send(
+    def send_did_change_noti(self, path: str, changes: List[Dict], text: PieceTable):
+        """Send the `changes` that turned the document into `text`, which is
+        sent instead where the server only supports full syncs."""
+        uri = path_to_uri(path)
+        self.versions[uri] += 1
+        self.notify(
             method="textDocument/didChange",
             params={
                 "textDocument": {
-                    "uri": "file://" + path,
-                    "version": 2,
+                    "uri": uri,
+                    "version": self.versions[uri],
                 },
-                "contentChanges": [
-                    {
-                        "text": text_document,
-                    }
-                ],
+                "contentChanges": changes,
             },
+            text=text,
         )
 
     def send_did_close_noti(self, path: str):
-        self.did_close_id = self.send(
+        uri = path_to_uri(path)
+        self.versions.pop(uri, None)
+        if len(self.versions) == 0:
+            self.idle_since = time.monotonic()
+        self.notify(
             method="textDocument/didClose",
             params={
                 "textDocument": {
-                    "uri": "file://" + path,
+                    "uri": uri,
                 }
             },
         )
 
     def send_did_save_noti(self, path: str):
-        self.did_save_id = self.send(
+        self.notify(
             method="textDocument/didSave",
             params={
                 "textDocument": {
-                    "uri": "file://" + path,
+                    "uri": path_to_uri(path),
                 },
-                "reason": 1,
             },
         )
+
+
+class LspManager:
+    """Language servers of every language with a command in `servers`.
+
+    A server is started when the first document of its language is opened,
+    and shared by every document of that language. Servers without open
+    documents for `idle_timeout` seconds are shut down by `shutdown_idle`."""
+
+    def __init__(
+        self,
+        servers: Dict[str, List[str]],
+        idle_timeout: float,
+        root: Optional[str] = None,
+    ) -> None:
+        # Command of the server of every language, by language identifier
+        self.commands = servers
+        self.idle_timeout = idle_timeout
+        self.root_uri = None if root is None else path_to_uri(root)
+        self.servers: Dict[str, ThreadedLsp] = {}
+        # Languages whose server failed to start, not retried until the
+        # settings change
+        self.failed: Set[str] = set()
+        self._on_message: Optional[Callable[[], None]] = None
+
+    @property
+    def on_message(self) -> Optional[Callable[[], None]]:
+        return self._on_message
+
+    @on_message.setter
+    def on_message(self, on_message: Optional[Callable[[], None]]):
+        self._on_message = on_message
+        for server in self.servers.values():
+            server.on_message = on_message
+
+    def server_for(self, path: str) -> Optional[ThreadedLsp]:
+        """Server of the language of the file at `path`, started if needed."""
+        language = language_id(path)
+        if language is None or language in self.failed:
+            return None
+        if (server := self.servers.get(language)) is not None:
+            if not self._stale(server):
+                return server
+            del self.servers[language]
+            server.shutdown()
+        if (cmd := self.commands.get(language)) is None:
+            return None
+        try:
+            server = ThreadedLsp(
+                cmd,
+                language_target=language,
+                root_uri=self.root_uri,
+                on_message=self._on_message,
+            )
+        except OSError as e:
+            print(f"Failed to start the {language} language server: {e}")
+            self.failed.add(language)
+            return None
+        self.servers[language] = server
+        return server
+
+    def _stale(self, server: ThreadedLsp) -> bool:
+        # Started in another workspace, and not needed there anymore
+        return server.root_uri != self.root_uri and len(server.versions) == 0
+
+    def set_root(self, root: Optional[str]):
+        """Start servers in `root` from now on. Those started elsewhere are
+        replaced once they have no documents open."""
+        self.root_uri = None if root is None else path_to_uri(root)
+        self.shutdown_idle()
+
+    def update_settings(self, servers: Dict[str, List[str]], idle_timeout: float):
+        """Use new commands for the servers started from now on."""
+        self.commands = servers
+        self.idle_timeout = idle_timeout
+        self.failed.clear()
+
+    def shutdown_idle(self):
+        for language, server in list(self.servers.items()):
+            if server.is_idle(self.idle_timeout) or self._stale(server):
+                del self.servers[language]
+                server.shutdown()
+
+    def get_notification(self) -> Optional[Dict]:
+        for server in self.servers.values():
+            if (notification := server.get_notification()) is not None:
+                return notification
+        return None
+
+    def run_callback(self) -> bool:
+        """Call the callback of one finished request of any server."""
+        return any(server.run_callback() for server in self.servers.values())
+
+    def exit(self):
+        for server in self.servers.values():
+            server.exit()
+        self.servers.clear()
@@ -0,0 +1,266 @@
+from bisect import bisect_left
+from random import random
+from re import finditer
+from typing import List, Optional, Sequence, Tuple
+
+# Number of pieces after which the table is rebuilt from its text
+COMPACT_PIECES = 8192
+
+
+class _Piece:
+    """Node of a treap of pieces, in document order.
+
+    A piece is the `start`-`end` slice of `source`, which is never modified.
+    Nodes are never modified either, so a root is a snapshot of the document.
+    """
+
+    __slots__ = (
+        "source",
+        "newlines",
+        "start",
+        "end",
+        "breaks",
+        "priority",
+        "left",
+        "right",
+        "total_length",
+        "total_breaks",
+        "count",
+    )
+
+    def __init__(
+        self,
+        source: str,
+        newlines: Sequence[int],
+        start: int,
+        end: int,
+        breaks: int,
+        priority: float,
+        left: Optional["_Piece"],
+        right: Optional["_Piece"],
+    ) -> None:
+        self.source = source
+        # Offsets of every newline in `source`
+        self.newlines = newlines
+        self.start = start
+        self.end = end
+        # Number of newlines in this piece
+        self.breaks = breaks
+        self.priority = priority
+        self.left = left
+        self.right = right
+        self.total_length = end - start
+        self.total_breaks = breaks
+        self.count = 1
+        if left is not None:
+            self.total_length += left.total_length
+            self.total_breaks += left.total_breaks
+            self.count += left.count
+        if right is not None:
+            self.total_length += right.total_length
+            self.total_breaks += right.total_breaks
+            self.count += right.count
+
+    def with_children(
+        self, left: Optional["_Piece"], right: Optional["_Piece"]
+    ) -> "_Piece":
+        return _Piece(
+            self.source,
+            self.newlines,
+            self.start,
+            self.end,
+            self.breaks,
+            self.priority,
+            left,
+            right,
+        )
+
+    def sliced(
+        self,
+        start: int,
+        end: int,
+        left: Optional["_Piece"],
+        right: Optional["_Piece"],
+    ) -> "_Piece":
+        breaks = bisect_left(self.newlines, end) - bisect_left(self.newlines, start)
+        return _Piece(
+            self.source,
+            self.newlines,
+            start,
+            end,
+            breaks,
+            self.priority,
+            left,
+            right,
+        )
+
+
+def _leaf(text: str) -> Optional[_Piece]:
+    if text == "":
+        return None
+    newlines = [m.start() for m in finditer("\n", text)]
+    return _Piece(text, newlines, 0, len(text), len(newlines), random(), None, None)
+
+
+def _length(node: Optional[_Piece]) -> int:
+    return 0 if node is None else node.total_length
+
+
+def _merge(a: Optional[_Piece], b: Optional[_Piece]) -> Optional[_Piece]:
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if a.priority > b.priority:
+        return a.with_children(a.left, _merge(a.right, b))
+    return b.with_children(_merge(a, b.left), b.right)
+
+
+def _split(
+    node: Optional[_Piece], offset: int
+) -> Tuple[Optional[_Piece], Optional[_Piece]]:
+    """Split into the first `offset` characters and the rest."""
+    if node is None:
+        return None, None
+    left_length = _length(node.left)
+    if offset <= left_length:
+        a, b = _split(node.left, offset)
+        return a, node.with_children(b, node.right)
+    offset -= left_length
+    if offset >= node.end - node.start:
+        a, b = _split(node.right, offset - (node.end - node.start))
+        return node.with_children(node.left, a), b
+    middle = node.start + offset
+    return (
+        node.sliced(node.start, middle, node.left, None),
+        node.sliced(middle, node.end, None, node.right),
+    )
+
+
+class PieceTable:
+    """Text of a document as pieces of the texts it was built from.
+
+    Edits and conversions between offsets and 1-based `line`.`col` positions
+    take O(log n), and `snapshot` is O(1)."""
+
+    def __init__(self, text: str = "") -> None:
+        self.root = _leaf(text)
+        self._text: Optional[str] = text
+
+    def __len__(self) -> int:
+        return _length(self.root)
+
+    @property
+    def line_count(self) -> int:
+        return 1 if self.root is None else self.root.total_breaks + 1
+
+    def snapshot(self) -> "PieceTable":
+        """A copy unaffected by later edits of this table."""
+        snapshot = PieceTable.__new__(PieceTable)
+        snapshot.root = self.root
+        snapshot._text = self._text
+        return snapshot
+
+    def _pieces(self, node: Optional[_Piece]) -> List[str]:
+        pieces: List[str] = []
+        stack: List[_Piece] = []
+        while node is not None or len(stack) > 0:
+            while node is not None:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            pieces.append(node.source[node.start : node.end])
+            node = node.right
+        return pieces
+
+    def text(self) -> str:
+        if self._text is None:
+            self._text = "".join(self._pieces(self.root))
+        return self._text
+
+    def slice(self, start: int, end: int) -> str:
+        if self._text is not None:
+            return self._text[start:end]
+        rest = _split(self.root, start)[1]
+        return "".join(self._pieces(_split(rest, end - start)[0]))
+
+    def insert(self, offset: int, text: str) -> None:
+        if text == "":
+            return
+        a, b = _split(self.root, offset)
+        self._set_root(_merge(_merge(a, _leaf(text)), b))
+
+    def delete(self, start: int, end: int) -> None:
+        if start >= end:
+            return
+        a, rest = _split(self.root, start)
+        self._set_root(_merge(a, _split(rest, end - start)[1]))
+
+    def _set_root(self, root: Optional[_Piece]) -> None:
+        self.root = root
+        self._text = None
+        if root is not None and root.count > COMPACT_PIECES:
+            text = self.text()
+            self.root = _leaf(text)
+            self._text = text
+
+    def line_offset(self, line: int) -> int:
+        """Offset of the start of `line`, or of the end for lines past it."""
+        breaks = line - 1
+        if breaks <= 0:
+            return 0
+        node = self.root
+        if node is None or breaks > node.total_breaks:
+            return len(self)
+        offset = 0
+        while node is not None:
+            left_breaks = 0 if node.left is None else node.left.total_breaks
+            if breaks <= left_breaks:
+                node = node.left
+                continue
+            breaks -= left_breaks
+            offset += _length(node.left)
+            if breaks <= node.breaks:
+                first = bisect_left(node.newlines, node.start)
+                return offset + node.newlines[first + breaks - 1] + 1 - node.start
+            breaks -= node.breaks
+            offset += node.end - node.start
+            node = node.right
+        return len(self)
+
+    def offset(self, line: int, col: int) -> int:
+        """Offset of `line`.`col`, clamped to the document like Tk does."""
+        start = self.line_offset(line)
+        if line > self.line_count:
+            return start
+        end = self.line_offset(line + 1)
+        if line < self.line_count:
+            end -= 1
+        return min(start + max(col, 0), end)
+
+    def position(self, offset: int) -> Tuple[int, int]:
+        """1-based line and 0-based column of `offset`."""
+        offset = min(max(offset, 0), len(self))
+        remaining = offset
+        line = 1
+        node = self.root
+        while node is not None:
+            left_length = _length(node.left)
+            if remaining < left_length:
+                node = node.left
+                continue
+            remaining -= left_length
+            line += 0 if node.left is None else node.left.total_breaks
+            if remaining < node.end - node.start:
+                line += bisect_left(
+                    node.newlines, node.start + remaining
+                ) - bisect_left(node.newlines, node.start)
+                break
+            remaining -= node.end - node.start
+            line += node.breaks
+            node = node.right
+        return line, offset - self.line_offset(line)
+
+    def index(self, offset: int) -> str:
+        """Tk `line.col` index of `offset`."""
+        return "%d.%d" % self.position(offset)
@@ -0,0 +1,121 @@
+from dataclasses import dataclass
+import os
+from queue import Empty, SimpleQueue
+import shutil
+import tempfile
+from threading import Condition, Thread
+from typing import Any, Callable, Dict, Optional
+
+from .piece_table import PieceTable
+
+# Permissions of new files, read once since reading it means changing it
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+@dataclass
+class SaveRequest:
+    path: str
+    # Snapshot of the text to write
+    text: PieceTable
+    file_id: Any
+    version: int
+
+
+@dataclass
+class SaveResult:
+    request: SaveRequest
+    # Set when the file could not be written
+    error: Optional[str] = None
+    size: int = 0
+    mtime_ns: int = 0
+
+
+def write_atomic(path: str, text: str) -> os.stat_result:
+    """Write `text` to a temporary file next to `path` and rename it over
+    `path` once it is on disk, so that `path` is never left half written."""
+    path = os.path.realpath(path)
+    directory, name = os.path.split(path)
+    fd, temporary_path = tempfile.mkstemp(dir=directory, prefix=f".{name}.")
+    try:
+        with open(fd, "w") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            shutil.copymode(path, temporary_path)
+        except FileNotFoundError:
+            os.chmod(temporary_path, 0o666 & ~_umask)
+        os.replace(temporary_path, path)
+    except BaseException:
+        try:
+            os.unlink(temporary_path)
+        except OSError:
+            pass
+        raise
+    if os.name == "posix":
+        # The rename itself is only durable once the directory is on disk
+        directory_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
+    return os.stat(path)
+
+
+class FileSaver:
+    """Writes files on a background thread.
+
+    Only the latest request for a path is written when several queue up, and
+    results are collected with `get_result`."""
+
+    def __init__(self, on_result: Optional[Callable[[], None]] = None) -> None:
+        # Called from the saving thread after every result is queued
+        self.on_result = on_result
+        # Requests not being written yet, in the order of their first request
+        self.pending: Dict[str, SaveRequest] = {}
+        self.writing: Optional[str] = None
+        self.results: "SimpleQueue[SaveResult]" = SimpleQueue()
+        self.condition = Condition()
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self, request: SaveRequest):
+        with self.condition:
+            self.pending[os.path.realpath(request.path)] = request
+            self.condition.notify_all()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until every queued request is written."""
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: len(self.pending) == 0 and self.writing is None, timeout
+            )
+
+    def get_result(self) -> Optional[SaveResult]:
+        try:
+            return self.results.get_nowait()
+        except Empty:
+            return None
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: len(self.pending) > 0)
+                path = next(iter(self.pending))
+                request = self.pending.pop(path)
+                self.writing = path
+            try:
+                stat = write_atomic(path, request.text.text())
+                result = SaveResult(
+                    request, size=stat.st_size, mtime_ns=stat.st_mtime_ns
+                )
+            except Exception as e:
+                result = SaveResult(request, error=str(e))
+            # Results are available before flush returns
+            self.results.put(result)
+            if self.on_result is not None:
+                self.on_result()
+            with self.condition:
+                self.writing = None
+                self.condition.notify_all()
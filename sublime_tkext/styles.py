@@ -0,0 +1,84 @@
+from dataclasses import dataclass
+from tkinter.font import Font
+from typing import Dict, Mapping, Optional, Tuple
+
+from pygments.token import _TokenType
+
+from .highlight import parse_styles
+
+FontKey = Tuple[str, int, str, str, bool]
+
+
+@dataclass(frozen=True)
+class StyleRecord:
+    foreground: Optional[str]
+    background: Optional[str]
+    bold: bool
+    italic: bool
+    underline: bool
+
+
+def compile_styles(theme: Mapping[_TokenType, str]) -> Dict[str, StyleRecord]:
+    return {
+        tag: StyleRecord(
+            foreground=style["foreground"],
+            background=style["background"],
+            bold=style["bold"] == True,
+            italic=style["italic"] == True,
+            underline=style["underline"] == True,
+        )
+        for tag, style in parse_styles(theme).items()
+    }
+
+
+class StyleRegistry:
+    """Compiled styles of the current theme and the fonts they use, shared by
+    every document of an `Editor`.
+
+    `revision` changes whenever the tag configuration of the documents has to
+    be redone."""
+
+    def __init__(
+        self, theme: Mapping[_TokenType, str], font_family: str, font_size: int
+    ) -> None:
+        self.theme = theme
+        self.records = compile_styles(theme)
+        self.font_family = font_family
+        self.font_size = font_size
+        self.fonts: Dict[FontKey, Font] = {}
+        self.revision = 0
+
+    def set_theme(self, theme: Mapping[_TokenType, str]) -> bool:
+        if theme is self.theme:
+            return False
+        self.theme = theme
+        self.records = compile_styles(theme)
+        self.revision += 1
+        return True
+
+    def set_font(self, family: str, size: int) -> bool:
+        if (family, size) == (self.font_family, self.font_size):
+            return False
+        self.font_family = family
+        self.font_size = size
+        self.revision += 1
+        return True
+
+    def font(self, record: StyleRecord) -> Font:
+        key = (
+            self.font_family,
+            self.font_size,
+            "bold" if record.bold else "normal",
+            "italic" if record.italic else "roman",
+            record.underline,
+        )
+        font = self.fonts.get(key)
+        if font is None:
+            font = self.fonts[key] = Font(
+                family=key[0],
+                size=key[1],
+                weight=key[2],
+                slant=key[3],
+                underline=key[4],
+            )
+        return font
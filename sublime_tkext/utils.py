@@ -1,19 +1,23 @@
 # /---- Evil hack to make the title bar dark (https://stackoverflow.com/a/70724666) ----\
 
 import ctypes as ct
+from dataclasses import dataclass
 import json
+import os
 from pathlib import Path
-from queue import Queue
-from re import compile
+from queue import SimpleQueue
+from re import compile, finditer
 from string import ascii_letters
-from subprocess import PIPE, Popen
-from threading import Thread
-from tkinter import END, INSERT, RIGHT, Canvas, Text
+from tkinter import END, INSERT, Canvas, TclError, Text
 from tkinter.ttk import Scrollbar
-from typing import Any, Dict, List, Optional, Protocol, Tuple, Union
+from typing import Any, Dict, Iterable, List, Optional, Protocol, Tuple, Union
 from platform import system
 
-from pylsp_jsonrpc import streams
+from .jsonrpc import JsonRpcClient, PendingRequest
+from .piece_table import PieceTable
+
+# Space on both sides of the line numbers
+GUTTER_PADDING = 10
 
 
 class Callback(Protocol):
@@ -38,6 +42,37 @@ def set_title_bar_color(window, dark: bool):
         set_window_attribute(hwnd, rendering_policy, ct.byref(value), ct.sizeof(value))
 
 
+class SelfPipe:
+    """Pipe that other threads write to so that a Tk file handler on it runs
+    on the main thread."""
+
+    def __init__(self) -> None:
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_blocking(self.read_fd, False)
+        os.set_blocking(self.write_fd, False)
+
+    def fileno(self) -> int:
+        return self.read_fd
+
+    def notify(self):
+        try:
+            os.write(self.write_fd, b"\0")
+        except OSError:
+            # Full pipes are already readable, closed ones have no handler
+            pass
+
+    def drain(self):
+        try:
+            while os.read(self.read_fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+
 # From: https://stackoverflow.com/questions/665566/redirect-command-line-results-to-a-tkinter-gui
 def iter_except(function, exception):
     """Works like builtin 2-argument `iter()`, but stops on `exception`."""
@@ -48,36 +83,126 @@ def iter_except(function, exception):
         return
 
 
+def offsets_to_indices(
+    text: str, line: int, col: int, offsets: Iterable[int]
+) -> List[str]:
+    """Convert increasing character offsets into `text`, which starts at Tk
+    index `line`.`col`, to Tk `line.col` indices in a single pass."""
+    indices: List[str] = []
+    newlines = [m.start() for m in finditer("\n", text)]
+    i = 0
+    line_start = -col
+    for offset in offsets:
+        while i < len(newlines) and newlines[i] < offset:
+            line += 1
+            line_start = newlines[i] + 1
+            i += 1
+        indices.append(f"{line}.{offset - line_start}")
+    return indices
+
+
 # From: https://stackoverflow.com/questions/16369470/tkinter-adding-line-number-to-text-widget
 class TextLineNumbers(Canvas):
-    def __init__(self, *args, textwidget: "StackOverflowText", **kwargs):
+    """Line numbers of the visible lines of `textwidget`, absolute or relative
+    to the line of the cursor.
+
+    Text items are reused between redraws and only reconfigured when their
+    number or position changed, and `redraw` runs at most once per idle
+    cycle."""
+
+    def __init__(
+        self,
+        *args,
+        textwidget: "StackOverflowText",
+        mode: str = "on",
+        **kwargs,
+    ):
         Canvas.__init__(self, *args, **kwargs)
         self.textwidget = textwidget
+        self.mode = mode
+        # Added to the line numbers of the text widget
+        self.line_offset = 0
+        self.foreground = "#858585"
+        self.current_foreground = "#c6c6c6"
+        # Canvas item of every visible line, and the text, y and color it
+        # shows, or None once hidden
+        self.items: List[int] = []
+        self.shown: List[Optional[Tuple[str, int, str]]] = []
+        self.digits = 0
+        self._redraw_pending = False
 
     def update_textwidget(self, textwidget):
         self.textwidget = textwidget
+        self.redraw()
 
-    def redraw(self, *args):
-        """redraw line numbers"""
-        self.delete("all")
+    def set_mode(self, mode: str):
+        self.mode = mode
+        self.redraw()
 
-        i = self.textwidget.index("@0,0")
-        while True:
-            dline = self.textwidget.dlineinfo(i)
-            if dline is None:
-                break
-            y = dline[1]
-            linenum = str(i).split(".")[0]
-            # print(self.textwidget.configure())
-            self.create_text(
-                4,
-                y,
-                anchor="nw",
-                text=linenum,
-                font=self.textwidget.cget("font"),
-                justify=RIGHT,
+    def update_font(self):
+        self.digits = 0
+        for item in self.items:
+            self.itemconfig(item, font=self.textwidget.cget("font"))
+        self.redraw()
+
+    def redraw(self, *args):
+        """Redraw the line numbers once idle."""
+        if self.mode != "off" and not self._redraw_pending:
+            self._redraw_pending = True
+            self.after_idle(self._redraw)
+
+    def _resize(self, line_count: int):
+        digits = max(len(str(line_count + self.line_offset)), 2)
+        if digits != self.digits:
+            self.digits = digits
+            width = self.tk.call(
+                "font", "measure", self.textwidget.cget("font"), "0" * digits
             )
-            i = self.textwidget.index("%s+1line" % i)
+            self.config(width=int(width) + 2 * GUTTER_PADDING)
+            # Every item has to move to the new right edge
+            self.shown = [("", -1, "") if shown else None for shown in self.shown]
+
+    def _redraw(self):
+        self._redraw_pending = False
+        if not self.winfo_exists():
+            return
+        self._resize(self.textwidget.buffer.line_count)
+        current = int(self.textwidget.index(INSERT).split(".")[0])
+        x = int(self.cget("width")) - GUTTER_PADDING
+
+        visible = 0
+        index = self.textwidget.index("@0,0")
+        while (dline := self.textwidget.dlineinfo(index)) is not None:
+            line = int(index.split(".")[0])
+            if self.mode == "relative" and line != current:
+                number = str(abs(line - current))
+            else:
+                number = str(line + self.line_offset)
+            color = self.current_foreground if line == current else self.foreground
+            shown = (number, dline[1], color)
+            if visible == len(self.items):
+                self.items.append(
+                    self.create_text(
+                        x, dline[1], anchor="ne", font=self.textwidget.cget("font")
+                    )
+                )
+                self.shown.append(("", -1, ""))
+            if self.shown[visible] != shown:
+                item = self.items[visible]
+                self.itemconfig(item, text=number, fill=color, state="normal")
+                self.coords(item, x, dline[1])
+                self.shown[visible] = shown
+            visible += 1
+            next_index = self.textwidget.index(f"{index}+1line")
+            if next_index == index:
+                break
+            index = next_index
+
+        # Items of lines that are not visible anymore are kept for later
+        for hidden in range(visible, len(self.items)):
+            if self.shown[hidden] is not None:
+                self.itemconfig(self.items[hidden], state="hidden")
+                self.shown[hidden] = None
 
 
 class ReportingBar(Scrollbar):
@@ -95,6 +220,18 @@ class ReportingBar(Scrollbar):
         return result
 
 
+@dataclass
+class TextChange:
+    """Replacement of the `start`-`end` range of the text by `text`.
+
+    Offsets are those of the text before the change, after the changes that
+    preceded it in the same batch."""
+
+    start: int
+    end: int
+    text: str
+
+
 # From: https://stackoverflow.com/a/40618152/11106801
 class StackOverflowText(Text):
     def __init__(self, *args, **kwargs):
@@ -106,6 +243,16 @@ class StackOverflowText(Text):
         self.tk.call("rename", self._w, self._orig)  # type: ignore
         self.tk.createcommand(self._w, self._proxy)  # type: ignore
 
+        # Python side copy of the text, kept in sync with every edit
+        self.buffer = PieceTable(self.tk.call(self._orig, "get", "1.0", "end-1c"))
+
+        # Changes since the last dispatch, which happens once per idle cycle
+        self.pending_changes: List[TextChange] = []
+        # Changes of the batch being dispatched, for the event handlers
+        self.changes: List[TextChange] = []
+        self._cursor_moved_at: Optional[int] = None
+        self._dispatch_id: Optional[str] = None
+
         self.bind("<Control-BackSpace>", self.ctrl_backspace)
         self.bind("<Control-Delete>", self.ctrl_delete)
 
@@ -125,6 +272,9 @@ class StackOverflowText(Text):
         #         if abs(col - old_col) == 1:
         #             print("left/right")
 
+        # Indices have to be resolved before the command moves the text
+        edits = self._resolve_edits(command, args)
+
         cmd = (self._orig, command) + args
         # print("calling the command:", cmd)
         try:
@@ -132,21 +282,136 @@ class StackOverflowText(Text):
         except Exception as e:
             print("proxy object had exception:", e)
             result = None
+            edits = None
+
+        if edits is not None:
+            self._apply_edits(edits)
+        elif command == "edit" and len(args) > 0 and args[0] in ("undo", "redo"):
+            # Depending on the Tk version undo and redo edit the text without
+            # going through this proxy
+            text = self.tk.call(self._orig, "get", "1.0", "end-1c")
+            if text != self.buffer.text():
+                self._record(0, len(self.buffer), text)
+                self.buffer = PieceTable(text)
 
-        if command in ("insert", "delete", "replace"):
-            self.event_generate("<<TextModified>>")
+        if mark_set:
+            self._cursor_moved_at = len(self.pending_changes)
+            self._schedule_dispatch()
 
-        if command == "insert":
-            self.event_generate("<<TextInserted>>")
-        elif command == "delete":
-            self.event_generate("<<TextDeleted>>")
-        elif command == "replace":
-            self.event_generate("<<TextReplaced>>")
+        return result
 
-        if mark_set:
+    def _record(self, start: int, end: int, text: str):
+        self.pending_changes.append(TextChange(start, end, text))
+        self._schedule_dispatch()
+
+    def _schedule_dispatch(self):
+        if self._dispatch_id is None:
+            self._dispatch_id = self.after_idle(self._dispatch)
+
+    def discard_changes(self):
+        """Forget the pending changes, such as those of loading a file."""
+        if self._dispatch_id is not None:
+            self.after_cancel(self._dispatch_id)
+            self._dispatch_id = None
+        self.pending_changes = []
+        self._cursor_moved_at = None
+
+    def flush_changes(self):
+        """Dispatch the pending changes now instead of when idle."""
+        if self._dispatch_id is not None:
+            self.after_cancel(self._dispatch_id)
+            self._dispatch()
+
+    def _dispatch(self):
+        self._dispatch_id = None
+        self.changes, self.pending_changes = self.pending_changes, []
+        cursor_moved_at, self._cursor_moved_at = self._cursor_moved_at, None
+        moved_last = cursor_moved_at is not None and cursor_moved_at == len(
+            self.changes
+        )
+        if cursor_moved_at is not None and not moved_last:
             self.event_generate("<<CursorMoved>>")
 
-        return result
+        if len(self.changes) > 0:
+            self.event_generate("<<TextModified>>")
+            last = self.changes[-1]
+            if last.start == last.end:
+                self.event_generate("<<TextInserted>>")
+            elif last.text == "":
+                self.event_generate("<<TextDeleted>>")
+            else:
+                self.event_generate("<<TextReplaced>>")
+
+        if moved_last:
+            self.event_generate("<<CursorMoved>>")
+
+    def destroy(self):
+        if self._dispatch_id is not None:
+            self.after_cancel(self._dispatch_id)
+            self._dispatch_id = None
+        super().destroy()
+
+    def _offset(self, index: str) -> int:
+        """Offset of `index` in `buffer`, where the empty line Tk keeps after
+        the final newline starts at `len(buffer) + 1`."""
+        line, col = (
+            int(i) for i in self.tk.call(self._orig, "index", index).split(".")
+        )
+        if line > self.buffer.line_count:
+            return len(self.buffer) + 1
+        return self.buffer.offset(line, col)
+
+    def _resolve_edits(
+        self, command: str, args: Tuple[Any, ...]
+    ) -> Optional[List[Tuple[int, int, str]]]:
+        """The (start, end, replacement) offset ranges an insert, delete or
+        replace command will change in `buffer`, in the order to apply them."""
+        if command not in ("insert", "delete", "replace"):
+            return None
+        try:
+            if str(self.tk.call(self._orig, "cget", "-state")) == "disabled":
+                # Tk silently ignores edits of a disabled widget
+                return None
+            if command == "insert":
+                return [(self._offset(args[0]), -1, "".join(args[1::2]))]
+            if command == "delete":
+                edits = []
+                for i in range(0, len(args), 2):
+                    start = self._offset(args[i])
+                    if i + 1 < len(args):
+                        end = self._offset(args[i + 1])
+                    else:
+                        end = min(start + 1, len(self.buffer) + 1)
+                    edits.append((start, end, ""))
+                # Tk deletes the ranges from the last one
+                return sorted(edits, reverse=True)
+            if command == "replace":
+                start, end = self._offset(args[0]), self._offset(args[1])
+                return [(start, end, "".join(args[2::2]))]
+        except (IndexError, ValueError, TclError):
+            # Tk reports the invalid command itself
+            return None
+        return None
+
+    def _apply_edits(self, edits: List[Tuple[int, int, str]]):
+        limit = len(self.buffer) + 1
+        for start, end, text in edits:
+            end = min(end, limit)
+            if start < end:
+                limit = start
+                if end == len(self.buffer) + 1:
+                    # The final newline is never deleted, Tk deletes the one
+                    # before the range instead when the range starts a line
+                    end -= 1
+                    if start > 0 and self.buffer.slice(start - 1, start) == "\n":
+                        start -= 1
+            else:
+                # Text can't be inserted after the final newline either
+                end = start = min(start, len(self.buffer))
+            if start < end or text != "":
+                self._record(start, end, text)
+                self.buffer.delete(start, end)
+                self.buffer.insert(start, text)
 
     def up_down_enable(self):
         self.up_down_enabled = True
@@ -236,24 +501,10 @@ class SetEncoder(json.JSONEncoder):
 
 class JsonRpcProcessProxy:
     def __init__(self, cmd: List[str]) -> None:
-        self.request_id = 0
-
-        self.process = Popen(
-            cmd,
-            stdin=PIPE,
-            stdout=PIPE,
-        )
-
-        self.rsp_queue: Queue[Dict] = Queue(maxsize=1024)
-        self.writer = streams.JsonRpcStreamWriter(self.process.stdin)
-        self.reader = streams.JsonRpcStreamReader(self.process.stdout)
-
-        self.thread = Thread(target=lambda: self.reader.listen(self.read), daemon=True)
-        self.thread.start()
-
-    def _generate_request_id(self) -> int:
-        self.request_id += 1
-        return self.request_id
+        # Notifications and requests from the process, responses complete the
+        # futures returned by `send` instead
+        self.rsp_queue: "SimpleQueue[Dict]" = SimpleQueue()
+        self.client = JsonRpcClient(cmd, on_message=self.read)
 
     def read(self, msg: Dict):
         self.rsp_queue.put(msg)
@@ -262,18 +513,8 @@ class JsonRpcProcessProxy:
         self,
         method: str,
         params: Optional[Union[Dict, List]] = None,
-    ):
-        self.writer.write(
-            {
-                "jsonrpc": "2.0",
-                "id": (out := self._generate_request_id()),
-                "method": method,
-                "params": params,
-            }
-        )
-        return out
+    ) -> PendingRequest:
+        return self.client.request(method, params)
 
     def exit(self):
-        self.process.kill()
-        self.writer.close()
-        self.reader.close()
+        self.client.close()
@@ -0,0 +1,62 @@
+import os
+import tempfile
+from tkinter import TclError, Tk
+import unittest
+
+from pygments.styles import get_style_by_name
+
+from sublime_tkext.config import Settings
+from sublime_tkext.editor import Editor
+from sublime_tkext.highlight import PygmentsHighlighter
+from sublime_tkext.lsp import LspManager
+
+
+class EditorTest(unittest.TestCase):
+    def setUp(self):
+        try:
+            self.root = Tk()
+        except TclError as e:
+            self.skipTest(f"No display: {e}")
+        self.addCleanup(self.root.destroy)
+        highlighter = PygmentsHighlighter(workers=1)
+        self.addCleanup(highlighter.close)
+        lsp = LspManager({}, idle_timeout=300)
+        self.addCleanup(lsp.exit)
+        self.editor = Editor(
+            self.root,
+            settings=Settings(),
+            theme=get_style_by_name("default").styles,  # type: ignore
+            lsp=lsp,
+            highlighter=highlighter,
+        )
+        self.editor.pack(fill="both", expand=True)
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.paths = []
+        for name in ("a.py", "b.py", "c.py"):
+            self.paths.append(path := os.path.join(directory.name, name))
+            with open(path, "w") as f:
+                f.write(f"{name[0]} = 1\n")
+
+    def test_select_restored_lazy_tabs(self):
+        # The way tabs of a workspace are restored
+        for path in self.paths:
+            self.editor.new_tab(path, lazy=True)
+        self.root.update()
+        for path in reversed(self.paths):
+            document = self.editor.get_tab_by_path(path)
+            self.assertIsNotNone(document)
+            self.editor.focus_document(document)
+            self.root.update()
+            self.assertTrue(document.materialized)
+            self.assertEqual(self.editor.select(), str(document))
+            self.assertEqual(len(self.editor.tabs()), len(self.paths))
+            self.assertEqual(
+                document.content.get("1.0", "end-1c"),
+                f"{os.path.basename(path)[0]} = 1\n",
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
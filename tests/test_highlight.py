@@ -0,0 +1,198 @@
+import random
+import unittest
+from typing import List, Optional
+from unittest import mock
+
+from pygments.lexer import Lexer
+from pygments.lexers import CLexer, GoLexer, LuaLexer, MarkdownLexer, PythonLexer
+
+from sublime_tkext import highlight
+from sublime_tkext.highlight import IncrementalLexer, TagTable
+
+CORPUS = '''import os
+
+
+def f(value, *args, **kwargs):
+    """Doc.
+
+    More.
+    """
+    text = f"{value!r} is 'odd'"
+    if value > 1:  # large values
+
+        return [x for x in range(value)]
+    s = \'\'\'
+    not a docstring
+    \'\'\'
+    return {"value": value, "text": text}
+
+
+class C:
+    """Class doc."""
+
+    def g(self):
+        return "\\n"
+'''
+
+SNIPPETS = ['"""', "'''", '"', "'", "#", "\n", "\n\n", "    ", "def ", "x = 1\n", "\\"]
+
+C_CORPUS = """#include <stdio.h>
+
+/* Doc.
+ */
+size_t f(uint8_t x) {
+    int64_t y = x;
+    return y + 1; // Comment
+}
+
+static FILE *g(void) { return NULL; }
+"""
+
+C_SNIPPETS = ["/*", "*/", '"', "\n", "size_t ", "{", "}", "#if 0\n", "#endif\n", "x("]
+
+
+class TaggedText:
+    """Tag name of every character, updated the way the editor applies
+    highlighting to the Text widget."""
+
+    def __init__(self, lexer: IncrementalLexer, text: str) -> None:
+        self.lexer = lexer
+        self.text = text
+        self.version = 0
+        self.tags: List[Optional[str]] = [None] * len(text)
+
+    def edit(self, start: int, end: int, inserted: str):
+        self.text = self.text[:start] + inserted + self.text[end:]
+        self.tags[start:end] = [None] * len(inserted)
+
+    def apply(self, chunk: highlight.Chunk):
+        start, end, tokens = chunk
+        self.tags[start:end] = [None] * (end - start)
+        for pos, length, tag_id in zip(tokens.starts, tokens.lengths, tokens.tag_ids):
+            name = self.lexer.tag_table.names[tag_id]
+            self.tags[pos : pos + length] = [name] * length
+
+    def highlight(self):
+        self.lexer.update(self.text, self.version, self.version - 1)
+        while self.lexer.busy:
+            self.apply(self.lexer.step())
+        self.version += 1
+
+    def check(self) -> int:
+        """Run the check of the document, returning how many characters it
+        re-highlighted."""
+        self.lexer.check()
+        changed = 0
+        while self.lexer.busy:
+            start, end, _ = chunk = self.lexer.step()
+            self.apply(chunk)
+            changed += end - start
+        return changed
+
+
+def full_lex(text: str, lexer: Lexer = PythonLexer()) -> List[Optional[str]]:
+    tags: List[Optional[str]] = [None] * len(text)
+    for pos, token_type, value in lexer.get_tokens_unprocessed(text):
+        tags[pos : pos + len(value)] = [str(token_type)] * len(value)
+    return tags
+
+
+class IncrementalLexerTest(unittest.TestCase):
+    def assert_matches_full_lex(self, tagged: TaggedText):
+        self.assertEqual(tagged.tags, full_lex(tagged.text), repr(tagged.text))
+
+    def test_docstring_closed_on_a_later_line(self):
+        tagged = TaggedText(IncrementalLexer(PythonLexer(), TagTable()), "")
+        for typed in ('def f():\n    """Doc.\n', "    More.\n", '    """\n'):
+            tagged.edit(len(tagged.text), len(tagged.text), typed)
+            tagged.highlight()
+            self.assert_matches_full_lex(tagged)
+
+    def random_edits(self, lexer: Lexer, text: str, snippets: List[str]):
+        rng = random.Random(0)
+        for _ in range(20):
+            tagged = TaggedText(IncrementalLexer(lexer, TagTable()), text)
+            tagged.highlight()
+            for _ in range(50):
+                start = rng.randrange(len(tagged.text) + 1)
+                if rng.random() < 0.3:
+                    end = min(len(tagged.text), start + rng.randrange(1, 10))
+                    tagged.edit(start, end, "")
+                else:
+                    tagged.edit(start, start, rng.choice(snippets))
+                tagged.highlight()
+                self.assertEqual(tagged.tags, full_lex(tagged.text, lexer))
+
+    def test_random_edits(self):
+        self.random_edits(PythonLexer(), CORPUS, SNIPPETS)
+
+    def test_random_edits_with_remapped_token_types(self):
+        # CLexer turns some names into types after lexing
+        self.assertTrue(highlight._supports_checkpoints(CLexer()))
+        self.random_edits(CLexer(), C_CORPUS, C_SNIPPETS)
+
+    def test_check_after_a_failed_match(self):
+        # The raw string only matches once the last line closes it
+        lexer = GoLexer()
+        tagged = TaggedText(IncrementalLexer(lexer, TagTable()), "")
+        for typed in ("package main\n\nvar s = `a\nb\n\nc\n", "`\n"):
+            tagged.edit(len(tagged.text), len(tagged.text), typed)
+            tagged.highlight()
+        self.assertGreater(tagged.check(), 0)
+        self.assertEqual(tagged.tags, full_lex(tagged.text, lexer))
+        # Nothing changed since
+        self.assertEqual(tagged.check(), 0)
+
+    @mock.patch.object(highlight, "CHUNK_LINES", 4)
+    def test_random_edits_then_check(self):
+        rng = random.Random(0)
+        text = "# Title\n\n```python\nx = 1\n\ny = 2\n\nSome `code`.\n\n```\nraw\n"
+        snippets = ["```\n", "```python\n", "`", "\n", "*", "x = '"]
+        for _ in range(10):
+            tagged = TaggedText(IncrementalLexer(MarkdownLexer(), TagTable()), text)
+            tagged.highlight()
+            self.assertEqual(tagged.check(), 0)
+            for _ in range(30):
+                start = rng.randrange(len(tagged.text) + 1)
+                if rng.random() < 0.3:
+                    end = min(len(tagged.text), start + rng.randrange(1, 10))
+                    tagged.edit(start, end, "")
+                else:
+                    tagged.edit(start, start, rng.choice(snippets))
+                tagged.highlight()
+                if rng.random() < 0.3:
+                    # Interrupted by the next edit
+                    tagged.lexer.check()
+                    tagged.apply(tagged.lexer.step())
+                    continue
+                tagged.check()
+                # Pygments gives the tokens of code blocks offsets from the
+                # start of the block, so a fresh lex is the reference
+                fresh = TaggedText(IncrementalLexer(MarkdownLexer(), TagTable()), "")
+                fresh.edit(0, 0, tagged.text)
+                fresh.highlight()
+                self.assertEqual(tagged.tags, fresh.tags, repr(tagged.text))
+
+    @mock.patch.object(highlight, "CHUNK_LINES", 4)
+    def test_chunks_without_checkpoints(self):
+        text = "function f(x)\n    --[[ x ]]\n    return x + 1\nend\n" * 10
+        document = IncrementalLexer(LuaLexer(), TagTable())
+        document.viewport = (21, 24)
+        tagged = TaggedText(document, text)
+        document.update(text)
+        # The visible lines come right after the first chunk
+        tagged.apply(document.step())
+        start, end, _ = visible = document.lex_viewport()  # type: ignore
+        self.assertEqual(text.count("\n", 0, start), 20)
+        self.assertEqual(text.count("\n", 0, end), 24)
+        tagged.apply(visible)
+        chunks = 1
+        while document.busy:
+            tagged.apply(document.step())
+            chunks += 1
+        self.assertGreater(chunks, 1)
+        self.assertEqual(tagged.tags, full_lex(text, LuaLexer()))
+
+
+if __name__ == "__main__":
+    unittest.main()
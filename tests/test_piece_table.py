@@ -0,0 +1,100 @@
+import random
+from typing import List, Tuple
+import unittest
+from unittest import mock
+
+from sublime_tkext import piece_table
+from sublime_tkext.piece_table import PieceTable
+
+SNIPPETS = ["a", "bc", "\n", "\n\n", "x\ny", "def f():\n    pass\n", "é", "\U0001f600"]
+
+
+def position(text: str, offset: int) -> Tuple[int, int]:
+    offset = min(max(offset, 0), len(text))
+    return text.count("\n", 0, offset) + 1, offset - text.rfind("\n", 0, offset) - 1
+
+
+def line_offset(text: str, line: int) -> int:
+    start = 0
+    for _ in range(line - 1):
+        if (start := text.find("\n", start) + 1) == 0:
+            return len(text)
+    return start
+
+
+def offset(text: str, line: int, col: int) -> int:
+    lines = text.split("\n")
+    if line > len(lines):
+        return len(text)
+    return line_offset(text, line) + min(max(col, 0), len(lines[line - 1]))
+
+
+class PieceTableTest(unittest.TestCase):
+    def assert_matches(self, table: PieceTable, text: str, rng: random.Random):
+        self.assertEqual(len(table), len(text))
+        self.assertEqual(table.line_count, text.count("\n") + 1)
+        for _ in range(5):
+            start = rng.randrange(len(text) + 1)
+            end = rng.randrange(start, len(text) + 1)
+            self.assertEqual(table.slice(start, end), text[start:end])
+            self.assertEqual(table.position(start), position(text, start))
+            self.assertEqual(table.index(start), "%d.%d" % position(text, start))
+            line = rng.randrange(table.line_count + 2)
+            self.assertEqual(table.line_offset(line), line_offset(text, line))
+            col = rng.randrange(-1, 20)
+            self.assertEqual(table.offset(line + 1, col), offset(text, line + 1, col))
+
+    def test_random_edits(self):
+        rng = random.Random(0)
+        for _ in range(20):
+            text = "".join(rng.choice(SNIPPETS) for _ in range(rng.randrange(20)))
+            table = PieceTable(text)
+            snapshots: List[Tuple[PieceTable, str]] = []
+            for step in range(300):
+                start = rng.randrange(len(text) + 1)
+                if rng.random() < 0.4:
+                    end = min(len(text), start + rng.randrange(1, 10))
+                    table.delete(start, end)
+                    text = text[:start] + text[end:]
+                else:
+                    inserted = rng.choice(SNIPPETS)
+                    table.insert(start, inserted)
+                    text = text[:start] + inserted + text[start:]
+                self.assert_matches(table, text, rng)
+                if rng.random() < 0.1:
+                    # Also with the text cached
+                    self.assertEqual(table.text(), text)
+                if rng.random() < 0.05:
+                    snapshots.append((table.snapshot(), text))
+            self.assertEqual(table.text(), text)
+            for snapshot, snapshot_text in snapshots:
+                self.assertEqual(snapshot.text(), snapshot_text)
+                self.assert_matches(snapshot, snapshot_text, rng)
+
+    @mock.patch.object(piece_table, "COMPACT_PIECES", 64)
+    def test_compaction(self):
+        rng = random.Random(1)
+        table, text = PieceTable(), ""
+        for _ in range(200):
+            start = rng.randrange(len(text) + 1)
+            table.insert(start, inserted := rng.choice(SNIPPETS))
+            text = text[:start] + inserted + text[start:]
+        self.assertIsNotNone(table.root)
+        self.assertLessEqual(table.root.count, 64)  # type: ignore
+        self.assert_matches(table, text, rng)
+        self.assertEqual(table.text(), text)
+
+    def test_empty(self):
+        table = PieceTable()
+        self.assertEqual(table.text(), "")
+        self.assertEqual(table.line_count, 1)
+        self.assertEqual(table.position(5), (1, 0))
+        self.assertEqual(table.line_offset(3), 0)
+        self.assertEqual(table.offset(2, 4), 0)
+        table.insert(0, "a\nb")
+        table.delete(0, 3)
+        self.assertEqual(table.text(), "")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+import random
+from tkinter import TclError, Tk
+import unittest
+
+from sublime_tkext.utils import StackOverflowText, offsets_to_indices
+
+SNIPPETS = ["a", "bc", "\n", "\n\n", "x\ny\n", "é"]
+
+
+class OffsetsToIndicesTest(unittest.TestCase):
+    def test_random_offsets(self):
+        rng = random.Random(0)
+        for _ in range(200):
+            text = "".join(rng.choice(SNIPPETS) for _ in range(rng.randrange(10)))
+            line, col = rng.randrange(1, 5), rng.randrange(5)
+            offsets = sorted(rng.randrange(len(text) + 1) for _ in range(5))
+            expected = []
+            for offset in offsets:
+                breaks = text.count("\n", 0, offset)
+                if breaks == 0:
+                    expected.append(f"{line}.{col + offset}")
+                else:
+                    line_start = text.rfind("\n", 0, offset) + 1
+                    expected.append(f"{line + breaks}.{offset - line_start}")
+            self.assertEqual(offsets_to_indices(text, line, col, offsets), expected)
+
+
+class StackOverflowTextTest(unittest.TestCase):
+    def setUp(self):
+        try:
+            self.root = Tk()
+        except TclError as e:
+            self.skipTest(f"No display: {e}")
+        self.addCleanup(self.root.destroy)
+        self.text = StackOverflowText(self.root)
+
+    def random_index(self, rng: random.Random) -> str:
+        lines = int(self.text.index("end").split(".")[0])
+        return rng.choice(
+            [
+                f"{rng.randrange(lines + 2)}.{rng.randrange(6)}",
+                f"{rng.randrange(1, lines + 1)}.0 lineend",
+                f"{rng.randrange(1, lines + 1)}.0 linestart",
+                "1.0",
+                "end",
+                "end-1c",
+                "end-2c",
+                "end+3c",
+            ]
+        )
+
+    def random_edit(self, rng: random.Random):
+        a, b = self.random_index(rng), self.random_index(rng)
+        kind = rng.randrange(5)
+        if kind == 0:
+            self.text.insert(a, rng.choice(SNIPPETS))
+        elif kind == 1:
+            self.text.delete(a)
+        elif kind == 2:
+            # Ranges that end before they start are ignored by Tk
+            self.text.delete(a, b)
+        elif kind == 3:
+            if self.text.compare(a, ">", b):
+                a, b = b, a
+            self.text.replace(a, b, rng.choice(SNIPPETS))
+        else:
+            c, d = self.random_index(rng), self.random_index(rng)
+            ranges = sorted(
+                (a, b, c, d),
+                key=lambda i: tuple(int(n) for n in self.text.index(i).split(".")),
+            )
+            self.text.tk.call(self.text._w, "delete", *ranges)  # type: ignore
+
+    def test_random_edits(self):
+        """The buffer follows the widget, final newline included, and the
+        recorded changes turn the previous text into the new one."""
+        rng = random.Random(0)
+        for _ in range(20):
+            self.text.delete("1.0", "end")
+            self.text.insert("1.0", "".join(rng.choice(SNIPPETS) for _ in range(5)))
+            self.text.discard_changes()
+            previous = self.text.buffer.text()
+            for _ in range(50):
+                self.random_edit(rng)
+                expected = self.text.get("1.0", "end-1c")
+                self.assertEqual(self.text.buffer.text(), expected)
+                for change in self.text.pending_changes:
+                    previous = (
+                        previous[: change.start] + change.text + previous[change.end :]
+                    )
+                self.text.discard_changes()
+                self.assertEqual(previous, expected)
+
+
+if __name__ == "__main__":
+    unittest.main()